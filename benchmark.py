@@ -0,0 +1,560 @@
+from aiohttp import web
+import requests
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import main
+
+# Offline benchmark: a stand-in Ollama server plus a load generator for BrainSystem and the two web servers.
+#   python benchmark.py run --target brain --requests 40 --concurrency 8
+#   python benchmark.py mock --port 11500 --token-latency 0.02     (just the mock, e.g. to point the UI at)
+
+# Mock Ollama defaults: seconds per generated token and per prompt token, +/- jitter as a fraction of each delay,
+# tokens per reply, and how often a request fails or the router answers with something that isn't JSON
+MOCK_HOST = "127.0.0.1"
+MOCK_PORT = 11500
+MOCK_MODEL = "mock"
+MOCK_TOKEN_LATENCY = 0.01
+MOCK_PROMPT_TOKEN_LATENCY = 0.0002
+MOCK_JITTER = 0.2
+MOCK_TOKENS = 24
+MOCK_ERROR_RATE = 0.0
+MOCK_MALFORMED_ROUTER_RATE = 0.0
+
+# Load generator defaults
+BENCH_REQUESTS = 20
+BENCH_CONCURRENCY = 4
+BENCH_SERVER_PORT = 5050
+BENCH_TIMEOUT = 120
+SAMPLE_INTERVAL = 0.05
+# Time to first event is measured to the first of these, i.e. the first content the user sees; progress updates
+# like "Routing..." go out before any model call
+FIRST_EVENTS = ("thought_token", "response_token", "brain_thought", "processing_complete")
+
+MOCK_WORDS = ("the", "signal", "feels", "familiar", "and", "calm", "memory", "suggests", "a", "careful", "plan",
+              "while", "attention", "stays", "on", "what", "matters", "most", "right", "now")
+
+class MockOllama:
+    def __init__(self, region_names, token_latency=MOCK_TOKEN_LATENCY, prompt_token_latency=MOCK_PROMPT_TOKEN_LATENCY,
+                 jitter=MOCK_JITTER, tokens=MOCK_TOKENS, error_rate=MOCK_ERROR_RATE,
+                 malformed_router_rate=MOCK_MALFORMED_ROUTER_RATE, seed=0):
+        self.region_names = list(region_names)
+        self.token_latency = token_latency
+        self.prompt_token_latency = prompt_token_latency
+        self.jitter = jitter
+        self.tokens = tokens
+        self.error_rate = error_rate
+        self.malformed_router_rate = malformed_router_rate
+        self.random = random.Random(seed)
+
+    def app(self):
+        mock_app = web.Application()
+        mock_app.router.add_get('/api/tags', self.tags)
+        mock_app.router.add_post('/api/generate', self.generate)
+        mock_app.router.add_post('/api/embed', self.embed)
+        return mock_app
+
+    def delay(self, seconds):
+        return max(0.0, seconds * self.random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def words(self, count):
+        return [self.random.choice(MOCK_WORDS) + " " for _ in range(count)]
+
+    def reply(self, prompt):
+        # Answer the way the real prompts expect: region selections for the router, JSON for batched regions
+        if "You are a router" in prompt or "Determine which brain regions" in prompt:
+            if self.random.random() < self.malformed_router_rate:
+                return ["Sure! ", "The ", "regions ", "are ", "Prefrontal ", "Cortex ", "and ", "Amygdala."]
+            chosen = set(self.random.sample(self.region_names, min(5, len(self.region_names))))
+            return [json.dumps({name: int(name in chosen or name == "Prefrontal Cortex") for name in self.region_names})]
+        if "JSON object keyed by region" in prompt:
+            names = re.findall(r"^- (.+?):", prompt, re.M)
+            return [json.dumps({name: "".join(self.words(self.tokens // 2)).strip() for name in names})]
+        return self.words(self.tokens)
+
+    async def tags(self, request):
+        return web.json_response({"models": [{"name": MOCK_MODEL}]})
+
+    async def embed(self, request):
+        payload = await request.json()
+        texts = payload.get("input") or []
+        texts = [texts] if isinstance(texts, str) else texts
+        return web.json_response({"embeddings": [[self.random.random() for _ in range(16)] for _ in texts]})
+
+    async def generate(self, request):
+        payload = await request.json()
+        prompt = payload.get("prompt", "")
+        if not prompt:
+            # An empty prompt only loads the model
+            return web.json_response({"model": payload.get("model"), "response": "", "done": True})
+        if self.random.random() < self.error_rate:
+            return web.json_response({"error": "mock failure"}, status=500)
+
+        prompt_tokens = main.estimate_tokens(prompt)
+        prefill = self.delay(prompt_tokens * self.prompt_token_latency)
+        parts = self.reply(prompt)
+        stats = {
+            "model": payload.get("model"),
+            "done": True,
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": int(prefill * 1e9),
+            "eval_count": len(parts),
+            "load_duration": 0
+        }
+
+        started = time.perf_counter()
+        await asyncio.sleep(prefill)
+        if not payload.get("stream"):
+            await asyncio.sleep(sum(self.delay(self.token_latency) for _ in parts))
+            stats["eval_duration"] = int((time.perf_counter() - started - prefill) * 1e9)
+            stats["total_duration"] = int((time.perf_counter() - started) * 1e9)
+            return web.json_response(dict(stats, response="".join(parts)))
+
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        for part in parts:
+            await asyncio.sleep(self.delay(self.token_latency))
+            await response.write((json.dumps({"model": payload.get("model"), "response": part, "done": False}) + "\n").encode())
+        stats["eval_duration"] = int((time.perf_counter() - started - prefill) * 1e9)
+        stats["total_duration"] = int((time.perf_counter() - started) * 1e9)
+        await response.write((json.dumps(dict(stats, response="")) + "\n").encode())
+        await response.write_eof()
+        return response
+
+def region_names():
+    return list(main.BrainSystem("http://unused", MOCK_MODEL, memory=main.MemoryStore(directory=None)).agents)
+
+def start_mock(args):
+    # The mock runs in its own process so it doesn't compete with the code being measured
+    command = [
+        sys.executable, os.path.abspath(__file__), "mock",
+        "--port", str(args.mock_port),
+        "--token-latency", str(args.token_latency),
+        "--prompt-token-latency", str(args.prompt_token_latency),
+        "--jitter", str(args.jitter),
+        "--tokens", str(args.tokens),
+        "--error-rate", str(args.error_rate),
+        "--malformed-router-rate", str(args.malformed_router_rate),
+        "--seed", str(args.seed)
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    url = f"http://{MOCK_HOST}:{args.mock_port}"
+    for _ in range(100):
+        try:
+            requests.get(f"{url}/api/tags", timeout=1)
+            return process, url
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Mock Ollama server did not start")
+
+class ResourceSampler:
+    # Tracks the peak thread count and resident memory of the process under test (this one, or the server's pid)
+    # while a run is going; another process can only be sampled through /proc
+    def __init__(self, pid=None, interval=SAMPLE_INTERVAL):
+        self.pid = pid
+        self.interval = interval
+        self.peak_threads = 0
+        self.peak_rss = 0
+        self.running = False
+
+    def threads(self):
+        if self.pid is None:
+            return threading.active_count()
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                return next(int(line.split()[1]) for line in f if line.startswith("Threads:"))
+        except (OSError, ValueError, StopIteration):
+            return 0
+
+    def rss(self):
+        try:
+            with open(f"/proc/{self.pid or 'self'}/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, AttributeError):
+            if self.pid is not None:
+                return 0
+            import resource
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+            return peak if sys.platform == "darwin" else peak * 1024
+
+    def sample(self):
+        while self.running:
+            self.peak_threads = max(self.peak_threads, self.threads())
+            self.peak_rss = max(self.peak_rss, self.rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, name="resource-sampler", daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.running = False
+        self.thread.join()
+
+def percentile(values, p):
+    # Nearest-rank percentile
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered), math.ceil(p / 100 * len(ordered))) - 1)]
+
+def message(i, mode, nonce):
+    # Every message is different so no run is answered from the response cache
+    topics = ("a noise in the dark", "a hard decision at work", "an old friend's name", "the smell of rain",
+              "learning to play the piano", "feeling hungry before bed")
+    return f"What do you make of {topics[i % len(topics)]}? (message {i}, {mode} mode, run {nonce})"
+
+def chat_body(args, url, mode, text, sid):
+    return {
+        'message': text,
+        'verbose': args.verbose,
+        'fastThinking': mode == "fast",
+        'stream': args.stream,
+        'router': args.router,
+        'deadline': args.deadline,
+        'singlePass': args.single_pass,
+        'batched': args.batched,
+        'sid': sid,
+        'ollama': {'api_url': url, 'model': MOCK_MODEL}
+    }
+
+async def drive_brain(args, url, mode, nonce):
+    # Calls process_input_async directly, many messages at once on one event loop
+    brain = main.BrainSystem(url, MOCK_MODEL, cache=main.ResponseCache(), memory=main.MemoryStore(directory=None))
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def one(i):
+        async with slots:
+            started = time.perf_counter()
+            first_event = []
+            async def emit(event, data):
+                if event in FIRST_EVENTS and not first_event:
+                    first_event.append(time.perf_counter() - started)
+            try:
+                await brain.process_input_async(
+                    message(i, mode, nonce), args.verbose, mode == "fast", args.stream, None, [], args.router, emit=emit,
+                    deadline=args.deadline, single_pass=args.single_pass, batched=args.batched
+                )
+            except Exception as e:
+                return {'error': str(e)}
+            return {'latency': time.perf_counter() - started, 'first_event': first_event[0] if first_event else None}
+
+    return await asyncio.gather(*[one(i) for i in range(args.requests)])
+
+class PollingClient:
+    # Just enough of a Socket.IO client, on Engine.IO's long-polling transport, to receive a server's events.
+    # socketio.Client stops delivering events after a fast burst of emits on this transport (e.g. with --stream
+    # --verbose), which made the server look like it timed out
+    def __init__(self, server_url, on_event):
+        self.url = f"{server_url}/socket.io/"
+        self.on_event = on_event
+        self.eio_sid = None
+        self.sid = None
+        self.running = False
+        # Separate sessions, since the reader's long poll is open while the writer answers pings
+        self.reader = requests.Session()
+        self.writer = requests.Session()
+
+    def params(self):
+        params = {'EIO': 4, 'transport': 'polling', 't': f"{time.time():.6f}"}
+        if self.eio_sid:
+            params['sid'] = self.eio_sid
+        return params
+
+    def receive(self):
+        response = self.reader.get(self.url, params=self.params(), timeout=BENCH_TIMEOUT)
+        response.raise_for_status()
+        # Engine.IO v4 separates the packets of one poll with a record separator
+        return response.text.split("\x1e")
+
+    def send(self, packet):
+        self.writer.post(self.url, params=self.params(), data=packet.encode('utf-8'), timeout=BENCH_TIMEOUT).raise_for_status()
+
+    def connect(self):
+        opened = self.receive()[0]
+        self.eio_sid = json.loads(opened[1:])['sid']
+        self.send("40")
+        while self.sid is None:
+            for packet in self.receive():
+                if packet.startswith("40"):
+                    self.sid = json.loads(packet[2:])['sid']
+                else:
+                    self.handle(packet)
+        self.running = True
+        self.thread = threading.Thread(target=self.poll, name="polling-client", daemon=True)
+        self.thread.start()
+
+    def handle(self, packet):
+        if packet == "2":
+            self.send("3")
+        elif packet.startswith("42"):
+            event, *data = json.loads(packet[2:])
+            self.on_event(event, data[0] if data else None)
+        elif packet == "1":
+            self.running = False
+
+    def poll(self):
+        while self.running:
+            try:
+                packets = self.receive()
+            except requests.exceptions.RequestException:
+                break
+            for packet in packets:
+                self.handle(packet)
+
+    def disconnect(self):
+        self.running = False
+        try:
+            self.send("41")
+            self.send("1")
+        except requests.exceptions.RequestException:
+            pass
+
+def drive_server(args, url, mode, nonce, server_url):
+    # Each virtual user keeps one Socket.IO connection and sends its messages one after another
+    results = []
+    lock = threading.Lock()
+
+    def user(indexes):
+        state = {}
+        done = threading.Event()
+
+        def on_event(event, data=None):
+            if event in FIRST_EVENTS and 'first_event' not in state:
+                state['first_event'] = time.perf_counter() - state['started']
+            if event == 'processing_complete':
+                done.set()
+        client = PollingClient(server_url, on_event)
+        client.connect()
+
+        for i in indexes:
+            state.clear()
+            done.clear()
+            state['started'] = time.perf_counter()
+            response = requests.post(f"{server_url}/chat", json=chat_body(args, url, mode, message(i, mode, nonce), client.sid))
+            if response.status_code != 200:
+                result = {'error': f"HTTP {response.status_code}: {response.json().get('status')}"}
+            elif not done.wait(BENCH_TIMEOUT):
+                result = {'error': "timed out"}
+            else:
+                result = {'latency': time.perf_counter() - state['started'], 'first_event': state.get('first_event')}
+            with lock:
+                results.append(result)
+        client.disconnect()
+
+    users = [threading.Thread(target=user, args=(range(u, args.requests, args.concurrency),)) for u in range(args.concurrency)]
+    for thread in users:
+        thread.start()
+    for thread in users:
+        thread.join()
+    return results
+
+def use_offline_state(job_db):
+    # Nothing should touch a real Ollama server, the on-disk memory or the server's job database while benchmarking
+    main.OLLAMA_WARMUP = []
+    main.memory_store = main.MemoryStore(directory=None)
+    main.job_store = main.JobQueue(path=job_db)
+
+def start_server(args, job_db):
+    # The server under test runs in its own process, so the threads and memory sampled are its own and not the
+    # load generator's
+    command = [
+        sys.executable, os.path.abspath(__file__), "serve",
+        "--target", args.target,
+        "--port", str(args.server_port),
+        "--job-db", job_db
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    server_url = f"http://{MOCK_HOST}:{args.server_port}"
+    wait_for_server(server_url, process)
+    return server_url, process
+
+def serve_target(args):
+    use_offline_state(args.job_db)
+    if args.target == "flask":
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        main.socketio.run(main.app, host=MOCK_HOST, port=args.port, debug=False, use_reloader=False, log_output=False)
+    else:
+        web.run_app(main.create_async_app(), host=MOCK_HOST, port=args.port, print=None)
+
+def wait_for_server(server_url, process):
+    for _ in range(100):
+        try:
+            requests.get(f"{server_url}/cache/stats", timeout=1)
+            return
+        except requests.exceptions.ConnectionError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"Server at {server_url} did not start")
+
+def failure_counts(server_url=None):
+    # Ollama calls that failed and router replies that couldn't be used so far, as counted by main in this process
+    # or by the server under test
+    if server_url is None:
+        ollama_errors = sum(value for (name, _), value in main.metrics.counters.items() if name == "ollama_errors_total")
+        return ollama_errors, main.router_stats.snapshot().get('fallbacks', 0)
+    errors_metric = f"{main.METRICS_PREFIX}ollama_errors_total"
+    ollama_errors = sum(
+        float(line.rsplit(" ", 1)[1]) for line in requests.get(f"{server_url}/metrics").text.splitlines()
+        if line.startswith(errors_metric)
+    )
+    return int(ollama_errors), requests.get(f"{server_url}/router/stats").json().get('fallbacks', 0)
+
+def summarize(mode, results, elapsed, sampler, failures):
+    latencies = [result['latency'] for result in results if 'latency' in result]
+    first_events = [result['first_event'] for result in results if result.get('first_event') is not None]
+    errors = [result['error'] for result in results if 'error' in result]
+    return {
+        'mode': mode,
+        'requests': len(results),
+        'errors': len(errors),
+        'latency_p50': percentile(latencies, 50),
+        'latency_p95': percentile(latencies, 95),
+        'latency_p99': percentile(latencies, 99),
+        'first_event_p50': percentile(first_events, 50),
+        'first_event_p95': percentile(first_events, 95),
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'peak_threads': sampler.peak_threads,
+        'peak_rss_mb': sampler.peak_rss / (1024 * 1024),
+        'ollama_errors': failures[0],
+        'router_fallbacks': failures[1],
+        'error_samples': sorted(set(errors))[:3]
+    }
+
+def print_report(args, reports):
+    print(f"target={args.target} requests={args.requests} concurrency={args.concurrency} router={args.router} "
+          f"stream={args.stream} single_pass={args.single_pass} batched={args.batched} deadline={args.deadline} "
+          f"token_latency={args.token_latency}s jitter={args.jitter} "
+          f"error_rate={args.error_rate} malformed_router_rate={args.malformed_router_rate}")
+    header = ("mode", "ok", "errors", "p50 s", "p95 s", "p99 s", "TTFE p50", "TTFE p95", "msg/s", "threads", "RSS MB",
+              "ollama err", "fallbacks")
+    print("".join(f"{column:>11}" for column in header))
+    format_seconds = lambda value: "-" if value is None else f"{value:.3f}"
+    for report in reports:
+        row = (
+            report['mode'], report['requests'] - report['errors'], report['errors'],
+            format_seconds(report['latency_p50']), format_seconds(report['latency_p95']), format_seconds(report['latency_p99']),
+            format_seconds(report['first_event_p50']), format_seconds(report['first_event_p95']),
+            f"{report['throughput']:.2f}", report['peak_threads'], f"{report['peak_rss_mb']:.1f}",
+            report['ollama_errors'], report['router_fallbacks']
+        )
+        print("".join(f"{value:>11}" for value in row))
+        for error in report['error_samples']:
+            print(f"{'':>11}error: {error}")
+
+def run(args):
+    job_dir = tempfile.mkdtemp(prefix="braingent-bench-")
+    job_db = os.path.join(job_dir, "jobs.db")
+    use_offline_state(job_db)
+    process, url = start_mock(args)
+    nonce = f"{time.time():.0f}"
+    reports = []
+    server_url, server = None, None
+    try:
+        if args.target != "brain":
+            server_url, server = start_server(args, job_db)
+
+        for mode in args.modes.split(","):
+            failures_before = failure_counts(server_url)
+            with ResourceSampler(server.pid if server else None) as sampler:
+                started = time.perf_counter()
+                if server_url:
+                    results = drive_server(args, url, mode, nonce, server_url)
+                else:
+                    results = main.async_runner.run(drive_brain(args, url, mode, nonce))
+                elapsed = time.perf_counter() - started
+            failures = [after - before for after, before in zip(failure_counts(server_url), failures_before)]
+            reports.append(summarize(mode, results, elapsed, sampler, failures))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        process.kill()
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+    print_report(args, reports)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({'settings': vars(args), 'results': reports}, f, indent=2)
+
+def serve_mock(args):
+    mock = MockOllama(
+        region_names(), args.token_latency, args.prompt_token_latency, args.jitter, args.tokens,
+        args.error_rate, args.malformed_router_rate, args.seed
+    )
+    print(f"Mock Ollama listening on http://{MOCK_HOST}:{args.port}")
+    web.run_app(mock.app(), host=MOCK_HOST, port=args.port, print=None)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark Braingent against a mock Ollama server")
+    commands = parser.add_subparsers(dest="command")
+
+    def mock_options(command):
+        command.add_argument("--token-latency", type=float, default=MOCK_TOKEN_LATENCY, help="seconds per generated token")
+        command.add_argument("--prompt-token-latency", type=float, default=MOCK_PROMPT_TOKEN_LATENCY, help="seconds per prompt token")
+        command.add_argument("--jitter", type=float, default=MOCK_JITTER, help="random +/- fraction applied to every delay")
+        command.add_argument("--tokens", type=int, default=MOCK_TOKENS, help="tokens per reply")
+        command.add_argument("--error-rate", type=float, default=MOCK_ERROR_RATE, help="fraction of requests answered with HTTP 500")
+        command.add_argument("--malformed-router-rate", type=float, default=MOCK_MALFORMED_ROUTER_RATE, help="fraction of router replies that aren't JSON")
+        command.add_argument("--seed", type=int, default=0)
+
+    run_command = commands.add_parser("run", help="run the benchmark")
+    run_command.add_argument("--target", choices=("brain", "flask", "async"), default="brain",
+                             help="call BrainSystem directly, or go through the Flask or aiohttp server")
+    run_command.add_argument("--modes", default="fast,full", help="comma-separated modes to measure")
+    run_command.add_argument("--requests", type=int, default=BENCH_REQUESTS, help="messages per mode")
+    run_command.add_argument("--concurrency", type=int, default=BENCH_CONCURRENCY, help="messages in flight at once")
+    run_command.add_argument("--router", choices=main.ROUTER_MODES, default=main.DEFAULT_ROUTER_MODE)
+    run_command.add_argument("--stream", action="store_true", help="stream tokens")
+    run_command.add_argument("--verbose", action="store_true", help="emit every region's thought")
+    run_command.add_argument("--single-pass", action=argparse.BooleanOptionalAction, default=main.SINGLE_PASS_INTEGRATION,
+                             help="integrate and answer with one Prefrontal call in fast mode")
+    run_command.add_argument("--batched", action=argparse.BooleanOptionalAction, default=main.BATCH_REGIONS,
+                             help="think for the regions in one call")
+    run_command.add_argument("--deadline", type=float, default=main.FAST_DEADLINE, help="fast-mode latency budget in seconds")
+    run_command.add_argument("--mock-port", type=int, default=MOCK_PORT)
+    run_command.add_argument("--server-port", type=int, default=BENCH_SERVER_PORT)
+    run_command.add_argument("--json", help="also write the results to this file")
+    mock_options(run_command)
+
+    serve_command = commands.add_parser("serve", help="run a server under test (started by run)")
+    serve_command.add_argument("--target", choices=("flask", "async"), default="flask")
+    serve_command.add_argument("--port", type=int, default=BENCH_SERVER_PORT)
+    serve_command.add_argument("--job-db", required=True, help="job database to use instead of the server's own")
+
+    mock_command = commands.add_parser("mock", help="only run the mock Ollama server")
+    mock_command.add_argument("--port", type=int, default=MOCK_PORT)
+    mock_options(mock_command)
+
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+        sys.exit(1)
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.command == "mock":
+        serve_mock(args)
+    elif args.command == "serve":
+        serve_target(args)
+    else:
+        run(args)
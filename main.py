@@ -1,80 +1,1200 @@
-from flask import Flask, render_template, request, jsonify
-from flask_socketio import SocketIO
-import requests
+from flask import Flask, Response, render_template, request, jsonify
+from flask_socketio import SocketIO, join_room
+from socketio import AsyncServer, KombuManager, PubSubManager, RedisManager
+from aiohttp import web
+import aiohttp
+import argparse
+import asyncio
+import atexit
+import contextlib
+import contextvars
+import inspect
+import pickle
 import json
 import time
 import threading
+import queue
 import random
 import sys
-import concurrent.futures
+import os
+import socket
+import subprocess
+import uuid
+import zlib
+import numpy as np
+import math
+import re
+import hashlib
+import sqlite3
+from collections import OrderedDict, deque
 
 app = Flask(__name__)
 socketio = SocketIO(app)
 
+# Timeouts (in seconds) for each kind of Ollama call
+OLLAMA_TIMEOUTS = {
+    "think": 300,
+    "router": 30,
+    "response": 60,
+    "summary": 60,
+    "embed": 30,
+    "batch": 300,
+    "warmup": 120
+}
+
+# How long Ollama keeps the model loaded after each kind of call, so it isn't unloaded between bursts
+OLLAMA_KEEP_ALIVE = {
+    "think": "30m",
+    "router": "30m",
+    "response": "30m",
+    "summary": "30m",
+    "embed": "30m",
+    "batch": "30m",
+    "warmup": "30m"
+}
+
+# Ollama's think option for each kind of call. False asks reasoning models to answer directly, so region thoughts
+# don't spend their num_predict cap on a reasoning block; kinds left out keep the model's default
+OLLAMA_THINK = {
+    "think": False,
+    "batch": False
+}
+
+# Ollama options for each kind of call. Ollama reloads the model whenever num_ctx changes, so keep num_ctx the same
+# for every call type that uses the same model; num_predict caps how many tokens each call may generate.
+OLLAMA_NUM_CTX = 4096
+OLLAMA_OPTIONS = {
+    "think": {"num_ctx": OLLAMA_NUM_CTX, "num_predict": 256},
+    "router": {"num_ctx": OLLAMA_NUM_CTX, "num_predict": 256},
+    "response": {"num_ctx": OLLAMA_NUM_CTX, "num_predict": 512},
+    "summary": {"num_ctx": OLLAMA_NUM_CTX, "num_predict": 128},
+    "batch": {"num_ctx": OLLAMA_NUM_CTX, "num_predict": 1024},
+    "warmup": {"num_ctx": OLLAMA_NUM_CTX}
+}
+
+# Models to load when the server starts, as (api_url, model) pairs, so the first chat doesn't wait for them
+OLLAMA_WARMUP = [("http://localhost:11434", "neural-chat")]
+
+def ollama_payload(payload, call_type):
+    # Add the call type's keep_alive and options, keeping any the caller set explicitly
+    payload = dict(payload)
+    if OLLAMA_KEEP_ALIVE.get(call_type) is not None:
+        payload.setdefault("keep_alive", OLLAMA_KEEP_ALIVE[call_type])
+    if OLLAMA_THINK.get(call_type) is not None:
+        payload.setdefault("think", OLLAMA_THINK[call_type])
+    options = dict(OLLAMA_OPTIONS.get(call_type, {}))
+    options.update(payload.get("options", {}))
+    if options:
+        payload["options"] = options
+    return payload
+
+# Reasoning models (e.g. deepseek-r1) wrap their chain of thought in these tags. It is left out of thoughts and
+# responses, so it is neither shown nor fed into later prompts
+REASONING_TAGS = ("<think>", "</think>")
+
+class ReasoningFilter:
+    # Passes streamed text through with reasoning blocks left out, even when a tag is split across tokens
+    def __init__(self):
+        self.pending = ""
+        self.reasoning = False
+    
+    def feed(self, token):
+        self.pending += token
+        visible = []
+        while True:
+            tag = REASONING_TAGS[1] if self.reasoning else REASONING_TAGS[0]
+            index = self.pending.find(tag)
+            if index < 0:
+                break
+            if not self.reasoning:
+                visible.append(self.pending[:index])
+            self.pending = self.pending[index + len(tag):]
+            self.reasoning = not self.reasoning
+        
+        # Hold back the end of the text if it could be the start of a tag
+        held = next((size for size in range(min(len(tag) - 1, len(self.pending)), 0, -1) if self.pending.endswith(tag[:size])), 0)
+        if not self.reasoning:
+            visible.append(self.pending[:len(self.pending) - held])
+        self.pending = self.pending[len(self.pending) - held:]
+        return "".join(visible)
+    
+    def flush(self):
+        text = "" if self.reasoning else self.pending
+        self.pending = ""
+        return text
+
+def strip_reasoning(text):
+    # Same rules as a stream, so a streamed answer and its final text agree: a block cut off by num_predict before
+    # it closes is dropped to the end, and a closing tag without an opening one is left as it is
+    visible = ReasoningFilter()
+    return (visible.feed(text) + visible.flush()).strip()
+
+# Connection pool and retry settings shared by all Ollama calls
+OLLAMA_POOL_SIZE_PER_HOST = 16
+OLLAMA_RETRIES = 2
+OLLAMA_RETRY_BACKOFF = 0.5
+
+class OllamaError(Exception):
+    pass
+
+# Ollama endpoints to balance across, keyed by the api_url a chat asks for; a comma-separated api_url also works
+OLLAMA_BACKENDS = {}
+# Consecutive failures before a backend is ejected, how long it stays out before a health check may readmit it,
+# and the health check itself
+BACKEND_MAX_FAILURES = 3
+BACKEND_EJECT_SECONDS = 30
+BACKEND_HEALTH_PATH = "/api/tags"
+BACKEND_HEALTH_TIMEOUT = 5
+
+class Backend:
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        self.failures = 0
+        # 0 while admitted, otherwise the time after which the backend may be health-checked
+        self.ejected_until = 0
+        self.requests = 0
+        self.errors = 0
+        self.ejections = 0
+
+class BackendPool:
+    def __init__(self, urls, max_failures=BACKEND_MAX_FAILURES, eject_seconds=BACKEND_EJECT_SECONDS):
+        self.backends = [Backend(url.strip().rstrip('/')) for url in urls if url.strip()]
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.lock = threading.Lock()
+    
+    def acquire(self, avoid=()):
+        # Pick the admitted backend with the fewest requests in flight (ties go to the one used least), preferring
+        # ones not in avoid. With every backend ejected, fall back to all of them rather than failing outright.
+        with self.lock:
+            candidates = [backend for backend in self.backends if not backend.ejected_until] or self.backends
+            candidates = [backend for backend in candidates if backend not in avoid] or candidates
+            backend = min(candidates, key=lambda backend: (backend.outstanding, backend.requests))
+            backend.outstanding += 1
+            backend.requests += 1
+            return backend
+    
+    def release(self, backend, healthy=True):
+        with self.lock:
+            backend.outstanding -= 1
+            if healthy:
+                backend.failures = 0
+                return
+            backend.errors += 1
+            backend.failures += 1
+            if backend.failures >= self.max_failures and not backend.ejected_until:
+                backend.ejected_until = time.time() + self.eject_seconds
+                backend.ejections += 1
+    
+    def due_for_check(self):
+        # Ejected backends whose time out is over; each is claimed for another period until a check readmits it
+        now = time.time()
+        with self.lock:
+            due = [backend for backend in self.backends if backend.ejected_until and backend.ejected_until <= now]
+            for backend in due:
+                backend.ejected_until = now + self.eject_seconds
+            return due
+    
+    def readmit(self, backend):
+        with self.lock:
+            backend.ejected_until = 0
+            backend.failures = 0
+    
+    def stats(self):
+        with self.lock:
+            return [{
+                'url': backend.url,
+                'outstanding': backend.outstanding,
+                'requests': backend.requests,
+                'errors': backend.errors,
+                'ejections': backend.ejections,
+                'ejected': bool(backend.ejected_until)
+            } for backend in self.backends]
+
+class BackendPools:
+    def __init__(self, backends=None):
+        self.backends = OLLAMA_BACKENDS if backends is None else backends
+        self.pools = {}
+        self.lock = threading.Lock()
+    
+    def get(self, api_url):
+        # One shared pool per api_url, so load and health are tracked across every brain that uses it
+        with self.lock:
+            pool = self.pools.get(api_url)
+            if pool is None:
+                pool = self.pools[api_url] = BackendPool(self.backends.get(api_url) or api_url.split(','))
+            return pool
+    
+    def stats(self):
+        with self.lock:
+            pools = dict(self.pools)
+        return {api_url: pool.stats() for api_url, pool in pools.items()}
+
+backend_pools = BackendPools()
+
+# Histogram buckets (in seconds) for the latency metrics served at /metrics
+METRICS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+METRICS_PREFIX = "braingent_"
+METRICS_HELP = {
+    "ollama_request_seconds": "Time from sending an Ollama request until its response was read, including queueing",
+    "ollama_queue_seconds": "Time an Ollama request waited for a free slot on its backend",
+    "ollama_load_seconds": "Time Ollama spent loading the model (load_duration)",
+    "ollama_prompt_eval_seconds": "Time Ollama spent on the prompt (prompt_eval_duration)",
+    "ollama_eval_seconds": "Time Ollama spent generating (eval_duration)",
+    "ollama_prompt_tokens_total": "Prompt tokens evaluated by Ollama (prompt_eval_count)",
+    "ollama_eval_tokens_total": "Tokens generated by Ollama (eval_count)",
+    "ollama_errors_total": "Ollama requests that failed",
+    "ollama_truncated_total": "Ollama generations stopped by num_predict",
+    "ollama_coalesced_total": "Ollama requests answered by an identical request already in flight",
+    "stage_seconds": "Time spent in each stage of processing a message",
+    "message_seconds": "Time to process a message from routing to the final response",
+    "chat_queue_seconds": "Time a chat waited for a free worker"
+}
+
+class Metrics:
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        # (name, labels) -> [count per bucket..., sum, count] for histograms, or the running total for counters
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+    
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+    
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+    
+    def render(self):
+        # Prometheus text exposition format
+        with self.lock:
+            histograms = {key: list(values) for key, values in self.histograms.items()}
+            counters = dict(self.counters)
+        
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+        
+        lines = []
+        described = set()
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {METRICS_PREFIX}{name} {METRICS_HELP.get(name, name)}")
+                lines.append(f"# TYPE {METRICS_PREFIX}{name} {kind}")
+        
+        for (name, labels), values in sorted(histograms.items()):
+            describe(name, "histogram")
+            # Buckets are cumulative already: each observation was counted in every bucket it fits
+            for bound, count in zip(self.buckets, values):
+                lines.append(f"{METRICS_PREFIX}{name}_bucket{label_text(labels, [('le', bound)])} {count}")
+            lines.append(f"{METRICS_PREFIX}{name}_bucket{label_text(labels, [('le', '+Inf')])} {values[-1]}")
+            lines.append(f"{METRICS_PREFIX}{name}_sum{label_text(labels)} {values[-2]}")
+            lines.append(f"{METRICS_PREFIX}{name}_count{label_text(labels)} {values[-1]}")
+        for (name, labels), value in sorted(counters.items()):
+            describe(name, "counter")
+            lines.append(f"{METRICS_PREFIX}{name}{label_text(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class MessageTrace:
+    # Timings for one message: how long each stage took and every Ollama call it made
+    def __init__(self, mode):
+        self.mode = mode
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.calls = []
+    
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(name, time.perf_counter() - started)
+    
+    def record_stage(self, name, seconds):
+        self.stages[name] = seconds
+        metrics.observe("stage_seconds", seconds, stage=name, mode=self.mode)
+    
+    def finish(self):
+        total = time.perf_counter() - self.started
+        metrics.observe("message_seconds", total, mode=self.mode)
+        return {
+            'total': round(total, 3),
+            'stages': {name: round(seconds, 3) for name, seconds in self.stages.items()},
+            'calls': self.calls
+        }
+
+# The trace of the message being processed; tasks started while handling a message inherit it
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+# Most requests one event loop may have in flight to a single Ollama backend
+OLLAMA_BACKEND_CONCURRENCY = 16
+OLLAMA_RETRY_STATUSES = (429, 502, 503, 504)
+# Let concurrent identical generations (same backend, model, prompt and options) share one Ollama call
+OLLAMA_COALESCE = True
+
+class SingleFlight:
+    # Concurrent callers with the same key share one task; it is only cancelled once every caller has gone
+    def __init__(self):
+        self.flights = {}
+    
+    def join(self, key, run, on_join=None):
+        # run(flight) is the coroutine behind a new flight
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = {"waiters": 0, "changed": asyncio.Event()}
+            flight["task"] = asyncio.ensure_future(run(flight))
+            flight["task"].add_done_callback(lambda task: self.finished(key, flight))
+            self.flights[key] = flight
+        elif on_join:
+            on_join()
+        flight["waiters"] += 1
+        return flight
+    
+    def finished(self, key, flight):
+        # Later callers start a new call rather than getting a finished result
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+        flight["changed"].set()
+    
+    def leave(self, flight):
+        flight["waiters"] -= 1
+        if not flight["waiters"] and not flight["task"].done():
+            flight["task"].cancel()
+    
+    async def call(self, key, factory, on_join=None):
+        flight = self.join(key, lambda flight: factory(), on_join)
+        try:
+            # Shielded so one caller being cancelled does not cancel the call for the others
+            return await asyncio.shield(flight["task"])
+        finally:
+            self.leave(flight)
+    
+    async def stream(self, key, factory, on_join=None):
+        # factory returns an async iterator of Ollama chunks. Only chunks some caller hasn't read yet are kept; the
+        # text of the rest is kept assembled, so a late joiner gets it as one chunk before the ones still buffered
+        async def pump(flight):
+            chunks = factory()
+            try:
+                async for chunk in chunks:
+                    flight["chunks"].append(chunk)
+                    flight["changed"].set()
+            finally:
+                await chunks.aclose()
+        
+        def prepare(flight):
+            flight.update({"chunks": [], "dropped": 0, "head": None, "text": [], "positions": {}})
+            return pump(flight)
+        
+        flight = self.join(key, prepare, on_join)
+        reader = object()
+        position = flight["dropped"]
+        flight["positions"][reader] = position
+        try:
+            if position:
+                yield dict(flight["head"], response="".join(flight["text"]), done=False)
+            while True:
+                while position < flight["dropped"] + len(flight["chunks"]):
+                    chunk = flight["chunks"][position - flight["dropped"]]
+                    position += 1
+                    flight["positions"][reader] = position
+                    self.compact(flight)
+                    yield chunk
+                if flight["task"].done():
+                    # Raises the call's error for every caller
+                    flight["task"].result()
+                    return
+                flight["changed"].clear()
+                await flight["changed"].wait()
+        finally:
+            del flight["positions"][reader]
+            self.compact(flight)
+            self.leave(flight)
+    
+    def compact(self, flight):
+        # Fold the chunks every caller has read into the assembled text
+        if not flight["positions"]:
+            return
+        read = min(flight["positions"].values()) - flight["dropped"]
+        if read <= 0:
+            return
+        for chunk in flight["chunks"][:read]:
+            if flight["head"] is None:
+                flight["head"] = chunk
+            flight["text"].append(chunk.get('response', ''))
+        del flight["chunks"][:read]
+        flight["dropped"] += read
+
+class AsyncOllamaClient:
+    def __init__(self, timeouts=None, pool_size_per_host=OLLAMA_POOL_SIZE_PER_HOST, retries=OLLAMA_RETRIES,
+                 backoff_factor=OLLAMA_RETRY_BACKOFF, backend_concurrency=OLLAMA_BACKEND_CONCURRENCY, coalesce=OLLAMA_COALESCE):
+        self.timeouts = dict(OLLAMA_TIMEOUTS)
+        self.timeouts.update(timeouts or {})
+        self.pool_size_per_host = pool_size_per_host
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.backend_concurrency = backend_concurrency
+        self.coalesce = coalesce
+        # aiohttp sessions and semaphores belong to the loop that created them, so keep one set per loop
+        self.loops = {}
+        # Health checks running in the background
+        self.checks = set()
+    
+    def state(self):
+        loop = asyncio.get_running_loop()
+        state = self.loops.get(loop)
+        if state is None:
+            connector = aiohttp.TCPConnector(limit_per_host=self.pool_size_per_host, keepalive_timeout=60)
+            state = {"session": aiohttp.ClientSession(connector=connector), "semaphores": {}, "flights": SingleFlight()}
+            self.loops[loop] = state
+        return state
+    
+    def timeout(self, call_type):
+        # A limit on connecting and on each wait for data, not on the whole generation
+        seconds = self.timeouts.get(call_type, OLLAMA_TIMEOUTS["think"])
+        return aiohttp.ClientTimeout(total=None, sock_connect=seconds, sock_read=seconds)
+    
+    def semaphore(self, url):
+        semaphores = self.state()["semaphores"]
+        if url not in semaphores:
+            semaphores[url] = asyncio.Semaphore(self.backend_concurrency)
+        return semaphores[url]
+    
+    def check_ejected(self, pool):
+        # Health-check ejected backends that are due, in the background so no request waits on them
+        for backend in pool.due_for_check():
+            task = asyncio.create_task(self.check(pool, backend))
+            self.checks.add(task)
+            task.add_done_callback(self.checks.discard)
+    
+    async def check(self, pool, backend):
+        try:
+            async with self.state()["session"].get(
+                f"{backend.url}{BACKEND_HEALTH_PATH}",
+                timeout=aiohttp.ClientTimeout(total=BACKEND_HEALTH_TIMEOUT)
+            ) as response:
+                healthy = response.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            healthy = False
+        if healthy:
+            pool.readmit(backend)
+    
+    def start_span(self, call_type, payload, labels=None):
+        return dict(labels or {}, call_type=call_type, model=payload.get("model", ""), started=time.perf_counter(), queued=0.0)
+    
+    def finish_span(self, span, result=None):
+        # Record the call's latency and Ollama's own timing and token fields, globally and for the current message
+        span = dict(span)
+        seconds = time.perf_counter() - span.pop("started")
+        queued = span.pop("queued")
+        backend = span.pop("backend", None)
+        if result is False:
+            metrics.increment("ollama_errors_total", **span)
+            return
+        result = result or {}
+        
+        metrics.observe("ollama_request_seconds", seconds, **span)
+        metrics.observe("ollama_queue_seconds", queued, **span)
+        call = dict(span, backend=backend, seconds=round(seconds, 3), queued=round(queued, 3))
+        for field, name in (("load_duration", "ollama_load_seconds"), ("prompt_eval_duration", "ollama_prompt_eval_seconds"),
+                            ("eval_duration", "ollama_eval_seconds")):
+            if field in result:
+                metrics.observe(name, result[field] / 1e9, **span)
+                call[field.replace("duration", "seconds")] = round(result[field] / 1e9, 3)
+        for field, name in (("prompt_eval_count", "ollama_prompt_tokens_total"), ("eval_count", "ollama_eval_tokens_total")):
+            if field in result:
+                metrics.increment(name, result[field], **span)
+                call[field] = result[field]
+        if result.get("done_reason") == "length":
+            metrics.increment("ollama_truncated_total", **span)
+            call["truncated"] = True
+        # Region thought lengths size the adaptive num_predict caps
+        if span["call_type"] == "think" and "region" in span and "eval_count" in result:
+            generation_limits.observe(span["region"], span.get("mode"), result["eval_count"])
+        
+        trace = current_trace.get()
+        if trace is not None:
+            trace.calls.append(call)
+    
+    @contextlib.asynccontextmanager
+    async def post(self, api_url, path, payload, call_type, span=None):
+        # Sent to the least busy healthy backend behind api_url and bounded per backend; connection failures and
+        # overloaded responses are retried with backoff, on a different backend when there is one
+        state = self.state()
+        pool = backend_pools.get(api_url)
+        self.check_ejected(pool)
+        tried = []
+        
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.backoff_factor * (2 ** (attempt - 1)))
+            backend = pool.acquire(tried)
+            tried.append(backend)
+            healthy = True
+            waiting = time.perf_counter()
+            try:
+                async with self.semaphore(backend.url):
+                    if span is not None:
+                        span["queued"] += time.perf_counter() - waiting
+                        span["backend"] = backend.url
+                    try:
+                        response = await state["session"].post(f"{backend.url}{path}", json=payload, timeout=self.timeout(call_type))
+                    except aiohttp.ClientConnectorError:
+                        healthy = False
+                        if attempt == self.retries:
+                            raise
+                        continue
+                    except (aiohttp.ClientError, asyncio.TimeoutError):
+                        healthy = False
+                        raise
+                    
+                    # A busy backend (429) is still healthy; gateway errors count against it
+                    healthy = response.status < 500
+                    if response.status in OLLAMA_RETRY_STATUSES and attempt < self.retries:
+                        response.release()
+                        continue
+                    
+                    try:
+                        yield response
+                    except (aiohttp.ClientError, asyncio.TimeoutError):
+                        healthy = False
+                        raise
+                    finally:
+                        response.release()
+                    return
+            finally:
+                pool.release(backend, healthy)
+    
+    def flight_key(self, api_url, payload, call_type, stream):
+        # Calls that would send Ollama exactly the same request
+        return (api_url, call_type, stream, json.dumps(ollama_payload(payload, call_type), sort_keys=True, default=str))
+    
+    def coalesced(self, call_type, payload, labels):
+        return lambda: metrics.increment("ollama_coalesced_total", **dict(labels or {}, call_type=call_type, model=payload.get("model", "")))
+    
+    async def generate(self, api_url, payload, call_type="think", labels=None):
+        # labels (e.g. region and mode) are attached to the call's metrics; an identical call already in flight is
+        # shared rather than sent again, and its metrics are recorded once, under the first caller's labels
+        if not self.coalesce:
+            return await self.generate_once(api_url, payload, call_type, labels)
+        result = await self.state()["flights"].call(
+            self.flight_key(api_url, payload, call_type, False),
+            lambda: self.generate_once(api_url, payload, call_type, labels),
+            self.coalesced(call_type, payload, labels)
+        )
+        return dict(result)
+    
+    async def generate_stream(self, api_url, payload, call_type="think", labels=None):
+        if not self.coalesce:
+            async for chunk in self.generate_stream_once(api_url, payload, call_type, labels):
+                yield chunk
+            return
+        async for chunk in self.state()["flights"].stream(
+            self.flight_key(api_url, payload, call_type, True),
+            lambda: self.generate_stream_once(api_url, payload, call_type, labels),
+            self.coalesced(call_type, payload, labels)
+        ):
+            yield chunk
+    
+    async def embed(self, api_url, model, texts):
+        payload = ollama_payload({"model": model, "input": texts}, "embed")
+        async with self.post(api_url, "/api/embed", payload, "embed") as response:
+            if response.status != 200:
+                raise OllamaError(f"{response.status} - {await response.text()}")
+            return (await response.json(content_type=None)).get('embeddings', [])
+    
+    async def generate_once(self, api_url, payload, call_type="think", labels=None):
+        span = self.start_span(call_type, payload, labels)
+        try:
+            async with self.post(api_url, "/api/generate", ollama_payload(payload, call_type), call_type, span) as response:
+                if response.status != 200:
+                    raise OllamaError(f"{response.status} - {await response.text()}")
+                result = await response.json(content_type=None)
+        except Exception:
+            self.finish_span(span, False)
+            raise
+        self.finish_span(span, result)
+        return result
+    
+    async def generate_stream_once(self, api_url, payload, call_type="think", labels=None):
+        # Yield each NDJSON chunk as Ollama produces it instead of waiting for the full response
+        span = self.start_span(call_type, payload, labels)
+        try:
+            async with self.post(api_url, "/api/generate", ollama_payload(dict(payload, stream=True), call_type), call_type, span) as response:
+                if response.status != 200:
+                    raise OllamaError(f"{response.status} - {await response.text()}")
+                
+                async for line in response.content:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    if 'error' in chunk:
+                        raise OllamaError(chunk['error'])
+                    if chunk.get('done'):
+                        # The last chunk carries Ollama's timing and token counts
+                        self.finish_span(span, chunk)
+                        yield chunk
+                        break
+                    yield chunk
+        except Exception:
+            self.finish_span(span, False)
+            raise
+    
+    async def stream_text(self, api_url, payload, call_type, on_token, labels=None):
+        # Pass every token to on_token (a plain function or a coroutine function) and return the assembled text,
+        # both without reasoning blocks
+        parts = []
+        visible = ReasoningFilter()
+        async for chunk in self.generate_stream(api_url, payload, call_type, labels):
+            parts.append(visible.feed(chunk.get('response', '')))
+            if parts[-1]:
+                await maybe_await(on_token(parts[-1]))
+        parts.append(visible.flush())
+        if parts[-1]:
+            await maybe_await(on_token(parts[-1]))
+        return ''.join(parts)
+    
+    async def warm_up(self, api_url, model):
+        # An empty prompt makes Ollama load the model without generating anything; load it on every backend
+        session = self.state()["session"]
+        
+        async def load(url):
+            try:
+                async with session.post(
+                    f"{url}/api/generate",
+                    json=ollama_payload({"model": model}, "warmup"),
+                    timeout=self.timeout("warmup")
+                ) as response:
+                    await response.read()
+                    if response.status == 200:
+                        print(f"Loaded {model} on {url}")
+                    else:
+                        print(f"Could not load {model} on {url}: {response.status}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"Could not load {model} on {url}: {e}")
+        
+        await asyncio.gather(*[load(backend.url) for backend in backend_pools.get(api_url).backends])
+    
+    async def close(self):
+        state = self.loops.pop(asyncio.get_running_loop(), None)
+        if state:
+            await state["session"].close()
+
+async def maybe_await(value):
+    # Callbacks may be plain functions or coroutine functions
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+class AsyncRunner:
+    # Runs coroutines for the blocking API on one shared background event loop
+    def __init__(self):
+        self.loop = None
+        self.lock = threading.Lock()
+    
+    def run(self, coroutine):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name="brain-event-loop", daemon=True).start()
+                atexit.register(self.stop)
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+    
+    def stop(self):
+        # Close the loop's HTTP connections on exit
+        try:
+            asyncio.run_coroutine_threadsafe(async_ollama_client.close(), self.loop).result(timeout=5)
+        except Exception:
+            pass
+
+# Shared async client so every region, router and response call reuses the same connections
+async_ollama_client = AsyncOllamaClient()
+async_runner = AsyncRunner()
+
+# Response cache settings (set RESPONSE_CACHE_DB to a file path to keep the cache across restarts)
+RESPONSE_CACHE_SIZE = 2048
+RESPONSE_CACHE_TTL = None
+RESPONSE_CACHE_DB = None
+
+class ResponseCache:
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, db_path=RESPONSE_CACHE_DB):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # key -> (value, created timestamp), least recently used first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = None
+        if db_path:
+            # The table never holds more than max_entries rows, so it is read into memory once here; after that,
+            # lookups never touch the disk and writes go through one background thread, off the event loop
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, created REAL, used REAL)")
+            self.db.commit()
+            rows = self.db.execute(
+                "SELECT key, value, created FROM responses ORDER BY used DESC LIMIT ?", (max_entries,)
+            ).fetchall()
+            for key, value, created in reversed(rows):
+                self.entries[key] = (json.loads(value), created)
+            # Rows on disk (an upper bound, since replacing an entry counts again), to trim only when over the limit
+            self.rows = self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            self.writes = queue.Queue()
+            self.writer = threading.Thread(target=self.write, name="response-cache-writer", daemon=True)
+            self.writer.start()
+            atexit.register(self.close)
+    
+    @staticmethod
+    def make_key(model, region, mode, prompt):
+        # Normalize case and whitespace so trivially different prompts share an entry
+        normalized = " ".join(prompt.lower().split())
+        digest = hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+        return f"{model}|{region}|{mode}|{digest}"
+    
+    def expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+    
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.expired(entry[1]):
+                self.delete(key)
+                entry = None
+            
+            if entry is None:
+                self.misses += 1
+                return None
+            
+            self.hits += 1
+            self.entries.move_to_end(key)
+            if self.db:
+                self.writes.put(("used", key, time.time()))
+            return entry[0]
+    
+    def set(self, key, value):
+        now = time.time()
+        with self.lock:
+            self.entries[key] = (value, now)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            if self.db:
+                self.writes.put(("set", key, value, now))
+    
+    def delete(self, key):
+        self.entries.pop(key, None)
+        if self.db:
+            self.writes.put(("delete", key))
+    
+    def write(self):
+        # Apply queued writes in batches, one commit per batch, evicting least recently used rows beyond the limit
+        while True:
+            batch = [self.writes.get()]
+            while True:
+                try:
+                    batch.append(self.writes.get_nowait())
+                except queue.Empty:
+                    break
+            for op in batch:
+                if op is None:
+                    continue
+                if op[0] == "used":
+                    self.db.execute("UPDATE responses SET used = ? WHERE key = ?", (op[2], op[1]))
+                elif op[0] == "set":
+                    _, key, value, now = op
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO responses (key, value, created, used) VALUES (?, ?, ?, ?)",
+                        (key, json.dumps(value), now, now)
+                    )
+                    self.rows += 1
+                else:
+                    self.db.execute("DELETE FROM responses WHERE key = ?", (op[1],))
+            if self.rows > self.max_entries:
+                self.db.execute(
+                    "DELETE FROM responses WHERE key NOT IN (SELECT key FROM responses ORDER BY used DESC LIMIT ?)",
+                    (self.max_entries,)
+                )
+                self.rows = self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            self.db.commit()
+            if None in batch:
+                return
+    
+    def close(self):
+        # Write what is still queued before the process exits
+        self.writes.put(None)
+        self.writer.join(timeout=5)
+    
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self.entries)
+            }
+
+# Shared cache for region thoughts and router decisions
+response_cache = ResponseCache()
+
+# Per-call prompt budgets in (estimated) tokens; over-budget prompts are compacted before they are sent
+PROMPT_BUDGETS = {
+    "think": 1024,
+    "router": 1024,
+    "response": 2048,
+    "summary": 1024
+}
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English text
+    return (len(text) + 3) // 4
+
+def truncate_to_tokens(text, tokens):
+    max_chars = max(0, tokens) * 4
+    if len(text) <= max_chars:
+        return text
+    return text[:max(0, max_chars - 3)].rstrip() + "..."
+
+class PromptBudget:
+    def __init__(self, budgets=None):
+        self.budgets = dict(PROMPT_BUDGETS)
+        self.budgets.update(budgets or {})
+        # One entry per prompt sent while processing a message
+        self.sizes = []
+        self.lock = threading.Lock()
+    
+    def limit(self, call_type):
+        return self.budgets.get(call_type, PROMPT_BUDGETS["think"])
+    
+    def record(self, call_type, name, prompt, compacted=None):
+        with self.lock:
+            self.sizes.append({
+                'call': call_type,
+                'name': name,
+                'tokens': estimate_tokens(prompt),
+                'budget': self.limit(call_type),
+                'compacted': compacted or []
+            })
+    
+    def report(self):
+        with self.lock:
+            return list(self.sizes)
+
+# Output limits for region thoughts in each mode: num_predict caps how many tokens a thought may generate, and stop
+# ends it at any of the sequences (e.g. when the model starts writing another prompt). REGION_LIMITS overrides them
+# for particular regions, e.g. {"Brainstem": {"fast": {"num_predict": 48}}}
+THINK_LIMITS = {
+    "fast": {"num_predict": 96, "stop": ["\nInput:", "\nContext:"]},
+    "full": {"num_predict": 256, "stop": ["\nInput:", "\nContext from other brain regions:"]}
+}
+REGION_LIMITS = {}
+# Adaptive caps: once a region has ADAPTIVE_LIMIT_MIN_SAMPLES thoughts in a mode, its num_predict becomes
+# ADAPTIVE_LIMIT_HEADROOM times the ADAPTIVE_LIMIT_PERCENTILE of its last ADAPTIVE_LIMIT_WINDOW thought lengths,
+# between ADAPTIVE_LIMIT_FLOOR and the configured cap. If many thoughts hit the cap, the percentile reaches it and
+# the cap grows back.
+ADAPTIVE_LIMITS = True
+ADAPTIVE_LIMIT_PERCENTILE = 0.95
+ADAPTIVE_LIMIT_HEADROOM = 1.5
+ADAPTIVE_LIMIT_WINDOW = 200
+ADAPTIVE_LIMIT_MIN_SAMPLES = 20
+ADAPTIVE_LIMIT_FLOOR = 32
+
+class GenerationLimits:
+    def __init__(self, window=ADAPTIVE_LIMIT_WINDOW):
+        self.window = window
+        # (region, mode) -> recent thought lengths in tokens (Ollama's eval_count)
+        self.lengths = {}
+        self.lock = threading.Lock()
+    
+    def observe(self, region, mode, tokens):
+        with self.lock:
+            self.lengths.setdefault((region, mode), deque(maxlen=self.window)).append(tokens)
+    
+    def configured(self, region, mode):
+        limits = dict(THINK_LIMITS.get(mode, {}))
+        limits.update(REGION_LIMITS.get(region, {}).get(mode, {}))
+        return limits
+    
+    def percentile(self, region, mode):
+        # None until there are enough samples
+        with self.lock:
+            lengths = sorted(self.lengths.get((region, mode), ()))
+        if len(lengths) < ADAPTIVE_LIMIT_MIN_SAMPLES:
+            return None
+        return lengths[max(0, math.ceil(ADAPTIVE_LIMIT_PERCENTILE * len(lengths)) - 1)]
+    
+    def options(self, region, mode):
+        # The configured limits, with num_predict lowered to what the region's thoughts actually need
+        limits = self.configured(region, mode)
+        observed = self.percentile(region, mode) if ADAPTIVE_LIMITS else None
+        if observed is not None and limits.get("num_predict") is not None:
+            limits["num_predict"] = max(ADAPTIVE_LIMIT_FLOOR, min(limits["num_predict"], math.ceil(observed * ADAPTIVE_LIMIT_HEADROOM)))
+        return limits
+    
+    def snapshot(self):
+        with self.lock:
+            keys = sorted(self.lengths)
+        limits = {}
+        for region, mode in keys:
+            limits.setdefault(region, {})[mode] = {
+                "samples": len(self.lengths[(region, mode)]),
+                "percentile": self.percentile(region, mode),
+                "num_predict": self.options(region, mode).get("num_predict")
+            }
+        return limits
+
+generation_limits = GenerationLimits()
+
 class BrainAgent:
-    def __init__(self, name, role, api_url, model):
+    def __init__(self, name, role, api_url, model, client=None, cache=None):
         self.name = name
         self.role = role
         self.api_url = api_url
         self.model = model
+        self.client = client or async_ollama_client
+        self.cache = cache or response_cache
         
-    def think(self, context, prompt, fast_mode=False):
+    def build_prompt(self, context, prompt, fast_mode=False):
+        # The input and context come first and the region-specific instructions last, so every region's prompt
+        # starts with the same text and Ollama can reuse the already processed prefix
         # Use simplified prompts in fast mode
         if fast_mode:
-            full_prompt = f"""
-As the {self.name} (Role: {self.role}), give a very brief response (1-2 sentences) to: {prompt}
+            return f"""
+Input: {prompt}
 Context: {context}
+
+As the {self.name} (Role: {self.role}), give a very brief response (1-2 sentences) to the input.
 """
-        else:
-            full_prompt = f"""
-You are the {self.name} part of a human brain.
-Your role: {self.role}
+        return f"""
+Input: {prompt}
 
-Focus only on how the {self.name} would process and respond to this input.
 Context from other brain regions: {context}
 
-Input: {prompt}
-
+You are the {self.name} part of a human brain.
+Your role: {self.role}
+Focus only on how the {self.name} would process and respond to this input.
 Give a brief response (2-5 sentences) from the perspective of the {self.name}.
 """
+    
+    def think(self, context, prompt, fast_mode=False, on_token=None, budget=None):
+        return async_runner.run(self.think_async(context, prompt, fast_mode, on_token, budget))
+    
+    async def think_async(self, context, prompt, fast_mode=False, on_token=None, budget=None):
+        budget = budget or PromptBudget()
+        full_prompt = self.build_prompt(context, prompt, fast_mode)
+        
+        # Shorten the context from other regions if the prompt is over budget
+        overflow = estimate_tokens(full_prompt) - budget.limit("think")
+        compacted = []
+        if overflow > 0 and context:
+            context = truncate_to_tokens(context, estimate_tokens(context) - overflow)
+            full_prompt = self.build_prompt(context, prompt, fast_mode)
+            compacted.append("truncated_context")
+        budget.record("think", self.name, full_prompt, compacted)
         
+        # Answer repeated prompts from the cache
+        cache_key = self.cache.make_key(self.model, self.name, "fast" if fast_mode else "full", full_prompt)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            if on_token:
+                await maybe_await(on_token(cached))
+            return cached
+        
+        mode = "fast" if fast_mode else "full"
+        payload = {
+            "model": self.model,
+            "prompt": full_prompt,
+            "stream": False,
+            # Bound how long the thought can run, so one rambling region can't hold up the message
+            "options": generation_limits.options(self.name, mode)
+        }
+        
+        labels = {"region": self.name, "mode": mode}
         try:
-            response = requests.post(
-                f"{self.api_url}/api/generate",
-                json={
-                    "model": self.model,
-                    "prompt": full_prompt,
-                    "stream": False
-                },
-                timeout=300
-            )
-            
-            if response.status_code == 200:
-                return response.json().get('response', '').strip()
+            # Stream tokens to the caller when a callback is given
+            if on_token:
+                thought = (await self.client.stream_text(self.api_url, payload, "think", on_token, labels)).strip()
             else:
-                return f"Error: {response.status_code} - {response.text}"
-        except requests.exceptions.Timeout:
+                thought = strip_reasoning((await self.client.generate(self.api_url, payload, "think", labels)).get('response', ''))
+            # Nothing is left when the output limit cut the model off inside a reasoning block; report it as a failed
+            # thought (left out of integration and never cached) rather than an empty one
+            if not thought:
+                return "Error: Empty thought (the output limit may have cut off a reasoning block)"
+            self.cache.set(cache_key, thought)
+            return thought
+        except asyncio.TimeoutError:
             return "Error: Request timed out"
         except Exception as e:
             return f"Error: {str(e)}"
 
+# Router output settings: "schema" constrains Ollama to a JSON schema of region names, "json" to any JSON object
+ROUTER_OUTPUT_FORMAT = "schema"
+ROUTER_MAX_REGIONS = {"fast": 4, "full": 8}
+
+class RouterStats:
+    def __init__(self):
+        self.counts = {
+            'requests': 0,
+            'request_failures': 0,
+            'parse_failures': 0,
+            'unknown_regions': 0,
+            'capped': 0,
+            'fallbacks': 0
+        }
+        self.lock = threading.Lock()
+    
+    def record(self, name, amount=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+    
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+router_stats = RouterStats()
+
+# Adaptive routing. After each message, a region's utility is the share of its thought's new words (those not in the
+# input) that reappear in the final response, averaged per topic (the local router's best-matching region) over the
+# last ROUTER_UTILITY_WINDOW messages. Once a region has ROUTER_UTILITY_MIN_SAMPLES samples in a topic, it is pruned
+# below ROUTER_MIN_UTILITY (but kept with probability ROUTER_EXPLORE so it can recover), and the selection is capped
+# at the number of regions that usually reached ROUTER_USEFUL_UTILITY, never below ROUTER_MIN_BUDGET.
+# Set ROUTER_UTILITY_FILE to a JSON path to keep what was learned across restarts.
+ROUTER_ADAPTIVE = True
+ROUTER_UTILITY_WINDOW = 50
+ROUTER_UTILITY_MIN_SAMPLES = 5
+ROUTER_MIN_UTILITY = 0.1
+ROUTER_USEFUL_UTILITY = 0.2
+ROUTER_MIN_BUDGET = 2
+ROUTER_EXPLORE = 0.1
+ROUTER_UTILITY_FILE = None
+# How the fallback answers returned when a response call fails begin; they say nothing about region utility
+RESPONSE_FAILURES = ("Error generating response", "I'm sorry, but it's taking longer", "I apologize, but something went wrong")
+
+class RegionUtility:
+    def __init__(self, window=ROUTER_UTILITY_WINDOW, min_samples=ROUTER_UTILITY_MIN_SAMPLES, path=ROUTER_UTILITY_FILE):
+        self.window = window
+        self.min_samples = min_samples
+        self.path = path
+        # (topic, region) -> [mean utility, samples]; (mode, topic) -> [mean useful regions, messages];
+        # mode -> [mean active regions, messages]
+        self.regions = {}
+        self.useful = {}
+        self.active = {}
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            self.load()
+    
+    @staticmethod
+    def overlap(thought, response, user_input):
+        words = set(tokenize(thought)) - set(tokenize(user_input))
+        if not words:
+            return 0.0
+        return len(words & set(tokenize(response))) / len(words)
+    
+    def update(self, table, key, value):
+        # A running mean that only remembers about the last window samples, so utility can change over time
+        entry = table.setdefault(key, [0.0, 0])
+        entry[1] += 1
+        entry[0] += (value - entry[0]) / min(entry[1], self.window)
+    
+    def record(self, topic, mode, user_input, thoughts, response, active):
+        scores = {name: self.overlap(thought, response, user_input) for name, thought in thoughts.items()}
+        with self.lock:
+            for name, score in scores.items():
+                self.update(self.regions, (topic, name), score)
+            self.update(self.useful, (mode, topic), sum(1 for score in scores.values() if score >= ROUTER_USEFUL_UTILITY))
+            self.update(self.active, mode, active)
+            if self.path:
+                self.save()
+        return scores
+    
+    def utility(self, topic, region):
+        # None until the region has enough samples in this topic
+        with self.lock:
+            entry = self.regions.get((topic, region))
+        return entry[0] if entry and entry[1] >= self.min_samples else None
+    
+    def budget(self, topic, mode):
+        with self.lock:
+            entry = self.useful.get((mode, topic))
+        if entry is None or entry[1] < self.min_samples:
+            return None
+        return max(ROUTER_MIN_BUDGET, math.ceil(entry[0]))
+    
+    def save(self):
+        state = {
+            "regions": [[topic, region, mean, count] for (topic, region), (mean, count) in self.regions.items()],
+            "useful": [[mode, topic, mean, count] for (mode, topic), (mean, count) in self.useful.items()],
+            "active": [[mode, mean, count] for mode, (mean, count) in self.active.items()]
+        }
+        with open(f"{self.path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(f"{self.path}.tmp", self.path)
+    
+    def load(self):
+        with open(self.path, encoding='utf-8') as f:
+            state = json.load(f)
+        self.regions = {(topic, region): [mean, count] for topic, region, mean, count in state.get("regions", [])}
+        self.useful = {(mode, topic): [mean, count] for mode, topic, mean, count in state.get("useful", [])}
+        self.active = {mode: [mean, count] for mode, mean, count in state.get("active", [])}
+    
+    def snapshot(self):
+        with self.lock:
+            topics = {}
+            for (topic, region), (mean, count) in sorted(self.regions.items()):
+                topics.setdefault(topic, {"regions": {}, "useful_regions": {}})["regions"][region] = {
+                    "utility": round(mean, 3), "samples": count
+                }
+            for (mode, topic), (mean, count) in sorted(self.useful.items()):
+                topics.setdefault(topic, {"regions": {}, "useful_regions": {}})["useful_regions"][mode] = round(mean, 2)
+            return {
+                "average_active_regions": {mode: round(mean, 2) for mode, (mean, count) in self.active.items()},
+                "topics": topics
+            }
+
+region_utility = RegionUtility()
+
 class RouterAgent:
-    def __init__(self, api_url, model):
+    def __init__(self, api_url, model, client=None, cache=None, ranker=None, utility=None, explore=ROUTER_EXPLORE):
         self.api_url = api_url
         self.model = model
+        self.client = client or async_ollama_client
+        self.cache = cache or response_cache
+        # Optional function ranking regions by relevance to an input, used when a selection must be trimmed
+        self.ranker = ranker
+        self.utility = utility or region_utility
+        self.explore = explore
         
-    def determine_relevant_regions(self, user_input, all_regions, fast_mode=False):
+    def build_prompt(self, user_input, all_regions, fast_mode=False):
         # In fast mode, use a simpler prompt and request fewer regions
         if fast_mode:
-            prompt = f"""
+            return f"""
 Determine which brain regions should process: "{user_input}"
 Available regions: {', '.join(all_regions.keys())}
 Return only JSON with region names and 0/1 values.
 Always include Prefrontal Cortex (1).
 In fast mode: select only 3-4 most essential regions.
 """
-        else:
-            prompt = f"""
+        return f"""
 You are a router in a human brain simulation. Your job is to determine which brain regions should be activated to process the following input:
 
 "{user_input}"
@@ -89,52 +1209,160 @@ Example: {{"Prefrontal Cortex": 1, "Amygdala": 0, ...}}
 Always include the Prefrontal Cortex (value 1) as it's the supervisor.
 Be selective - only activate regions truly relevant to the input (typically 4-7 regions + Prefrontal Cortex).
 """
+    
+    def determine_relevant_regions(self, user_input, all_regions, fast_mode=False, budget=None):
+        return async_runner.run(self.determine_relevant_regions_async(user_input, all_regions, fast_mode, budget))
+    
+    async def determine_relevant_regions_async(self, user_input, all_regions, fast_mode=False, budget=None):
+        budget = budget or PromptBudget()
+        prompt = self.build_prompt(user_input, all_regions, fast_mode)
+        
+        # Only the quoted input can grow, so shorten it if the prompt is over budget
+        overflow = estimate_tokens(prompt) - budget.limit("router")
+        compacted = []
+        if overflow > 0:
+            prompt = self.build_prompt(truncate_to_tokens(user_input, estimate_tokens(user_input) - overflow), all_regions, fast_mode)
+            compacted.append("truncated_input")
+        budget.record("router", "Router", prompt, compacted)
+        
+        # Reuse the routing decision for a repeated input
+        cache_key = self.cache.make_key(self.model, "Router", "fast" if fast_mode else "full", prompt)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            return dict(cached)
         
+        payload = {
+            "model": self.model,
+            "prompt": prompt,
+            "stream": False
+        }
+        # Constrain the model's output to a JSON object of known regions
+        if ROUTER_OUTPUT_FORMAT == "schema":
+            payload["format"] = self.selection_schema(all_regions)
+        elif ROUTER_OUTPUT_FORMAT == "json":
+            payload["format"] = "json"
+        
+        router_stats.record('requests')
         try:
-            response = requests.post(
-                f"{self.api_url}/api/generate",
-                json={
-                    "model": self.model,
-                    "prompt": prompt,
-                    "stream": False
-                },
-                timeout=30
-            )
-            
-            if response.status_code == 200:
-                response_text = response.json().get('response', '').strip()
-                # Extract JSON object from response
-                try:
-                    # Find the first { and last } to extract JSON
-                    start = response_text.find('{')
-                    end = response_text.rfind('}') + 1
-                    if start >= 0 and end > start:
-                        json_str = response_text[start:end]
-                        return json.loads(json_str)
-                    else:
-                        # Fallback to activating essential regions
-                        if fast_mode:
-                            return self.get_essential_regions(all_regions)
-                        else:
-                            return {region: 1 for region in all_regions.keys()}
-                except json.JSONDecodeError:
-                    # Fallback to activating essential regions
-                    if fast_mode:
-                        return self.get_essential_regions(all_regions)
-                    else:
-                        return {region: 1 for region in all_regions.keys()}
-            else:
-                # Fallback to activating essential regions
-                if fast_mode:
-                    return self.get_essential_regions(all_regions)
-                else:
-                    return {region: 1 for region in all_regions.keys()}
-        except:
-            # Fallback to activating essential regions
-            if fast_mode:
-                return self.get_essential_regions(all_regions)
+            response = await self.client.generate(self.api_url, payload, "router", {"region": "Router", "mode": "fast" if fast_mode else "full"})
+        except Exception:
+            router_stats.record('request_failures')
+            return self.fallback_regions(all_regions)
+        
+        response_text = strip_reasoning(response.get('response', ''))
+        selection = self.parse_selection(response_text, all_regions)
+        if selection is None:
+            router_stats.record('parse_failures')
+            return self.fallback_regions(all_regions)
+        
+        selection = self.cap_selection(selection, user_input, fast_mode)
+        self.cache.set(cache_key, selection)
+        return dict(selection)
+    
+    def selection_schema(self, all_regions):
+        return {
+            "type": "object",
+            "properties": {name: {"type": "integer", "enum": [0, 1]} for name in all_regions},
+            "required": list(all_regions)
+        }
+    
+    def parse_selection(self, response_text, all_regions):
+        # Extract the JSON object and keep only known region names with 0/1 values; None if unusable
+        start = response_text.find('{')
+        end = response_text.rfind('}') + 1
+        if start < 0 or end <= start:
+            return None
+        try:
+            raw = json.loads(response_text[start:end])
+        except json.JSONDecodeError:
+            return None
+        if not isinstance(raw, dict):
+            return None
+        
+        unknown = [name for name in raw if name not in all_regions]
+        if unknown:
+            router_stats.record('unknown_regions', len(unknown))
+        
+        selection = {}
+        for region in all_regions:
+            value = raw.get(region, 0)
+            if isinstance(value, str):
+                value = value.strip().lower() in ("1", "true", "yes")
+            selection[region] = 1 if value else 0
+        selection["Prefrontal Cortex"] = 1
+        return selection
+    
+    def cap_selection(self, selection, user_input, fast_mode=False):
+        # Keep at most ROUTER_MAX_REGIONS active, preferring the regions the ranker scores highest
+        limit = ROUTER_MAX_REGIONS["fast" if fast_mode else "full"]
+        active = [name for name, value in selection.items() if value == 1 and name != "Prefrontal Cortex"]
+        if len(active) + 1 <= limit:
+            return selection
+        
+        router_stats.record('capped')
+        if self.ranker:
+            rank = {name: position for position, (name, _) in enumerate(self.ranker(user_input))}
+            active.sort(key=lambda name: rank.get(name, len(rank)))
+        keep = set(active[:max(0, limit - 1)])
+        return {name: 1 if name == "Prefrontal Cortex" or name in keep else 0 for name in selection}
+    
+    def topic(self, user_input):
+        # The region the ranker matches best stands in for the input's topic
+        if self.ranker:
+            ranked = self.ranker(user_input)
+            if ranked and ranked[0][1] > 0:
+                return ranked[0][0]
+        return "general"
+    
+    def prune_selection(self, selection, user_input, fast_mode=False):
+        # Drop regions that have rarely contributed to answers on this topic, then cap the rest at the learned budget
+        if not ROUTER_ADAPTIVE:
+            return selection
+        topic = self.topic(user_input)
+        active = [name for name, value in selection.items() if value == 1 and name != "Prefrontal Cortex"]
+        utilities = {name: self.utility.utility(topic, name) for name in active}
+        
+        kept, explored, pruned = [], [], []
+        for name in active:
+            if utilities[name] is None or utilities[name] >= ROUTER_MIN_UTILITY:
+                kept.append(name)
+            elif random.random() < self.explore:
+                explored.append(name)
             else:
-                return {region: 1 for region in all_regions.keys()}
+                pruned.append(name)
+        
+        # Regions without enough samples rank first so they get measured, then the most useful ones
+        rank = lambda name: -1.0 if utilities[name] is None else utilities[name]
+        kept.sort(key=rank, reverse=True)
+        budget = self.utility.budget(topic, "fast" if fast_mode else "full")
+        if budget is not None and len(kept) > budget:
+            router_stats.record('budget_capped')
+            pruned += kept[budget:]
+            kept = kept[:budget]
+        # Never prune below the minimum budget
+        pruned.sort(key=rank, reverse=True)
+        while pruned and len(kept) + len(explored) < ROUTER_MIN_BUDGET:
+            kept.append(pruned.pop(0))
+        
+        if pruned:
+            router_stats.record('pruned', len(pruned))
+        keep = set(kept + explored)
+        return {name: 1 if name == "Prefrontal Cortex" or name in keep else 0 for name in selection}
+    
+    def learn(self, user_input, thoughts, response, fast_mode=False, active=0):
+        # Record how much each region's thought contributed to the final response
+        if not ROUTER_ADAPTIVE or response.startswith(RESPONSE_FAILURES):
+            return
+        contributions = {
+            name: thought for name, thought in thoughts.items()
+            if name != "Prefrontal Cortex" and thought and not thought.startswith("Error:")
+        }
+        self.utility.record(self.topic(user_input), "fast" if fast_mode else "full", user_input, contributions, response, active)
+    
+    def fallback_regions(self, all_regions):
+        # A failed routing call activates the small essential set instead of every region
+        router_stats.record('fallbacks')
+        return self.get_essential_regions(all_regions)
     
     def get_essential_regions(self, all_regions):
         # Core regions that are always needed for basic processing
@@ -152,14 +1380,383 @@ Be selective - only activate regions truly relevant to the input (typically 4-7
                 
         return essential_regions
 
+# Local router settings: how many regions to pick per mode, and the score below which hybrid mode asks the LLM
+LOCAL_ROUTER_TOP_K = {"fast": 3, "full": 6}
+LOCAL_ROUTER_CONFIDENCE = 0.1
+ROUTER_MODES = ("llm", "local", "hybrid")
+DEFAULT_ROUTER_MODE = "llm"
+
+# Words too common to say anything about which region is relevant
+STOP_WORDS = set("""
+a about all an and any are as at be been but by can could did do does for from had has have how i if in
+into is it its me my no not of on or our so some than that the their them then there these they this to
+us was we were what when where which who why will with would you your and other help other such you
+""".split())
+
+# Everyday words that point at each region, added to its role text for local routing
+REGION_KEYWORDS = {
+    "Prefrontal Cortex": "plan decide decision choose goal strategy think reason organize priority should advice",
+    "Amygdala": "fear scared afraid scary anxious anxiety worried nervous panic threat danger angry happy sad emotion feel",
+    "Hippocampus": "remember memory recall past childhood history forgot learn yesterday experience story",
+    "Temporal Lobe": "hear sound music song voice listen meaning word name face recognize fact know",
+    "Parietal Lobe": "where space spatial direction map distance position body touch math number size",
+    "Occipital Lobe": "see look picture image color colour visual light sunset view paint draw",
+    "Cerebellum": "move movement balance coordination sport dance practice skill timing rhythm",
+    "Broca's Area": "speak say write sentence grammar talk phrase express language pronounce",
+    "Wernicke's Area": "understand meaning definition explain read language word mean interpret",
+    "Anterior Cingulate Cortex": "mistake error wrong conflict doubt unsure dilemma contradiction focus",
+    "Thalamus": "attention notice focus alert sleep awake sense signal distract",
+    "Hypothalamus": "hungry hunger thirsty thirst food eat drink hot cold temperature tired hormone",
+    "Basal Ganglia": "habit routine reward motivation action do start stop addiction",
+    "Brainstem": "breathe breathing heart heartbeat alive survival reflex wake sleep pulse",
+    "Insula": "pain hurt disgust gross empathy sick nausea body gut inside feeling"
+}
+
+def tokenize(text):
+    # Lowercase words with stop words removed and common suffixes stripped
+    words = []
+    for word in re.findall(r"[a-z]+", text.lower()):
+        if word in STOP_WORDS or len(word) < 3:
+            continue
+        for suffix in ("ations", "ation", "ities", "ing", "ies", "ed", "es", "ly", "s", "y"):
+            if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+                word = word[:-len(suffix)]
+                break
+        words.append(word)
+    return words
+
+class LocalRouter:
+    def __init__(self, all_regions):
+        # Precompute a normalized TF-IDF vector for each region's name and role once
+        documents = {name: tokenize(f"{name} {role} {REGION_KEYWORDS.get(name, '')}") for name, role in all_regions.items()}
+        document_frequency = {}
+        for words in documents.values():
+            for word in set(words):
+                document_frequency[word] = document_frequency.get(word, 0) + 1
+        
+        total = len(documents)
+        self.idf = {word: math.log((1 + total) / (1 + count)) + 1 for word, count in document_frequency.items()}
+        self.vectors = {name: self.vectorize(words) for name, words in documents.items()}
+        
+    def vectorize(self, words):
+        counts = {}
+        for word in words:
+            if word in self.idf:
+                counts[word] = counts.get(word, 0) + 1
+        vector = {word: count * self.idf[word] for word, count in counts.items()}
+        norm = math.sqrt(sum(value * value for value in vector.values()))
+        return {word: value / norm for word, value in vector.items()} if norm else {}
+        
+    def score(self, user_input):
+        # Cosine similarity between the input and every region, best first
+        query = self.vectorize(tokenize(user_input))
+        scores = {
+            name: sum(weight * vector.get(word, 0.0) for word, weight in query.items())
+            for name, vector in self.vectors.items()
+        }
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        
+    def select(self, user_input, all_regions, fast_mode=False):
+        # Returns the 0/1 region selection and the top score as a confidence value
+        top_k = LOCAL_ROUTER_TOP_K["fast" if fast_mode else "full"]
+        ranked = [(name, score) for name, score in self.score(user_input) if name != "Prefrontal Cortex"]
+        chosen = {name for name, score in ranked[:top_k] if score > 0}
+        selection = {region: 1 if region in chosen else 0 for region in all_regions}
+        selection["Prefrontal Cortex"] = 1
+        confidence = ranked[0][1] if ranked else 0.0
+        return selection, confidence
+
+# Long-term memory settings: where the vector index lives (None keeps it in RAM only), how much is recalled, and
+# which regions receive recalled memories as context
+MEMORY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "memory")
+MEMORY_EMBED_DIM = 512
+MEMORY_TOP_K = 3
+MEMORY_MIN_SCORE = 0.2
+MEMORY_CHUNK_SIZE = 800
+MEMORY_CONTEXT_REGIONS = ("Hippocampus",)
+
+class HashEmbedder:
+    # Feature-hashed bag of words: no model call, stable across restarts
+    def __init__(self, dim=MEMORY_EMBED_DIM):
+        self.dim = dim
+        
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in tokenize(text):
+                bucket = zlib.crc32(word.encode('utf-8'))
+                vectors[row, bucket % self.dim] += 1.0 if bucket & 0x80000000 else -1.0
+        return vectors
+
+class OllamaEmbedder:
+    def __init__(self, api_url, model, client=None):
+        self.api_url = api_url
+        self.model = model
+        self.client = client or async_ollama_client
+        
+    def embed(self, texts):
+        # The memory store embeds from worker threads, so the call runs on the shared background loop
+        return np.array(async_runner.run(self.client.embed(self.api_url, self.model, texts)), dtype=np.float32)
+
+class MemoryStore:
+    def __init__(self, embedder=None, directory=MEMORY_DIR):
+        self.embedder = embedder or HashEmbedder()
+        self.directory = directory
+        # One metadata record per stored memory; row i of self.vectors is its unit-length embedding
+        self.records = []
+        self.vectors = None
+        self.lock = threading.Lock()
+        if directory:
+            self.load()
+    
+    def path(self, name):
+        return os.path.join(self.directory, name)
+    
+    def load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.path("memories.jsonl")):
+            with open(self.path("memories.jsonl"), encoding='utf-8') as f:
+                self.records = [json.loads(line) for line in f if line.strip()]
+        
+        index = {}
+        if os.path.exists(self.path("index.json")):
+            with open(self.path("index.json")) as f:
+                index = json.load(f)
+        
+        dim = index.get("dim")
+        if self.records and dim and os.path.exists(self.path("vectors.f32")):
+            capacity = os.path.getsize(self.path("vectors.f32")) // (4 * dim)
+            if capacity >= len(self.records):
+                self.vectors = np.memmap(self.path("vectors.f32"), dtype=np.float32, mode='r+', shape=(capacity, dim))
+        
+        # Rebuild the vectors from the stored text if they are missing or came from a different embedder
+        if self.records and (self.vectors is None or self.vectors.shape[1] != self.embed(["probe"]).shape[1]):
+            self.vectors = None
+            texts = [record["text"] for record in self.records]
+            vectors = self.embed(texts)
+            self.ensure_capacity(len(texts), vectors.shape[1])
+            self.vectors[:len(texts)] = vectors
+            self.flush()
+    
+    def embed(self, texts):
+        vectors = np.asarray(self.embedder.embed(texts), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+    
+    def ensure_capacity(self, count, dim):
+        if self.vectors is not None and self.vectors.shape[0] >= count and self.vectors.shape[1] == dim:
+            return
+        
+        capacity = max(64, count, 2 * (self.vectors.shape[0] if self.vectors is not None else 0))
+        used = len(self.records) if self.vectors is not None and self.vectors.shape[1] == dim else 0
+        if self.directory:
+            # Grow the memory-mapped file by writing a larger copy and swapping it in
+            temp_path = self.path("vectors.f32.tmp")
+            grown = np.memmap(temp_path, dtype=np.float32, mode='w+', shape=(capacity, dim))
+            if used:
+                grown[:used] = self.vectors[:used]
+            grown.flush()
+            del grown
+            self.vectors = None
+            os.replace(temp_path, self.path("vectors.f32"))
+            self.vectors = np.memmap(self.path("vectors.f32"), dtype=np.float32, mode='r+', shape=(capacity, dim))
+            with open(self.path("index.json"), 'w') as f:
+                json.dump({"dim": dim}, f)
+        else:
+            grown = np.zeros((capacity, dim), dtype=np.float32)
+            if used:
+                grown[:used] = self.vectors[:used]
+            self.vectors = grown
+    
+    def flush(self):
+        if isinstance(self.vectors, np.memmap):
+            self.vectors.flush()
+    
+    def add(self, texts, kind, session_id=None, source=None):
+        texts = [text for text in texts if text.strip()]
+        if not texts:
+            return 0
+        vectors = self.embed(texts)
+        records = [
+            {"text": text, "kind": kind, "session_id": session_id, "source": source, "created": time.time()}
+            for text in texts
+        ]
+        with self.lock:
+            self.append(records, vectors)
+        return len(texts)
+    
+    def append(self, records, vectors):
+        # Called with self.lock held
+        start = len(self.records)
+        self.ensure_capacity(start + len(records), vectors.shape[1])
+        self.vectors[start:start + len(records)] = vectors
+        self.flush()
+        
+        # Vectors are written before their metadata, so a crash never leaves a record without a vector
+        if self.directory:
+            with open(self.path("memories.jsonl"), 'a', encoding='utf-8') as f:
+                for record in records:
+                    f.write(json.dumps(record) + "\n")
+        self.records.extend(records)
+    
+    def refresh(self):
+        # Called with self.lock held before searching; memories only change through this store
+        pass
+    
+    def add_exchange(self, user_input, response, session_id=None):
+        # Fallback answers from failed calls aren't worth recalling, and without a session there is nobody to recall
+        # an exchange for
+        if not session_id or response.startswith(RESPONSE_FAILURES):
+            return 0
+        return self.add([f"User: {user_input}\nSystem: {response}"], "exchange", session_id)
+    
+    def add_document(self, text, source=None, chunk_size=MEMORY_CHUNK_SIZE):
+        # Split on paragraphs, packing them into chunks of roughly chunk_size characters
+        chunks, current = [], ""
+        for paragraph in text.split("\n\n"):
+            if current and len(current) + len(paragraph) > chunk_size:
+                chunks.append(current)
+                current = ""
+            current = f"{current}\n\n{paragraph}" if current else paragraph
+            while len(current) > chunk_size:
+                chunks.append(current[:chunk_size])
+                current = current[chunk_size:]
+        if current:
+            chunks.append(current)
+        return self.add(chunks, "document", source=source)
+    
+    def search(self, query, k=MEMORY_TOP_K, session_id=None, min_score=MEMORY_MIN_SCORE):
+        # Top-k memories by cosine similarity; exchanges are only visible to the session they came from, and never to a
+        # request without one. The query is embedded before taking the lock, since that may be an Ollama call
+        query_vector = self.embed([query])[0]
+        with self.lock:
+            self.refresh()
+            count = len(self.records)
+            if not count:
+                return []
+            if query_vector.shape[0] != self.vectors.shape[1]:
+                return []
+            scores = self.vectors[:count] @ query_vector
+            visible = np.fromiter(
+                (record["kind"] != "exchange" or session_id is not None and record["session_id"] == session_id
+                 for record in self.records),
+                dtype=bool,
+                count=count
+            )
+            scores = np.where(visible, scores, -1.0)
+            top = np.argsort(-scores)[:k]
+            return [(float(scores[i]), self.records[i]) for i in top if scores[i] >= min_score]
+
+# Shared long-term memory used by the Hippocampus, opened by get_memory_store on first use so importing this module
+# doesn't create MEMORY_DIR
+memory_store = None
+memory_store_lock = threading.Lock()
+
+def get_memory_store():
+    global memory_store
+    with memory_store_lock:
+        if memory_store is None:
+            memory_store = MemoryStore()
+        return memory_store
+
+# Default number of nodes that may run at once within each stage of the full-mode pipeline
+STAGE_CONCURRENCY = {
+    "round1": 8,
+    "integration": 1,
+    "round2": 8,
+    "final": 1,
+    "response": 1
+}
+
+class PipelineScheduler:
+    def __init__(self, stage_limits=None, default_limit=4):
+        self.stage_limits = stage_limits or {}
+        self.default_limit = default_limit
+        self.nodes = {}
+        
+    def add_node(self, node_id, func, deps=None, stage=None):
+        # func receives the results of all finished nodes and returns this node's result
+        self.nodes[node_id] = {"func": func, "deps": list(deps or []), "stage": stage}
+        
+    async def run(self, on_complete=None, on_stage_start=None):
+        # Node functions and callbacks are coroutine functions; nodes run as tasks on the current event loop
+        results = {}
+        remaining = dict(self.nodes)
+        running = {}
+        stage_running = {}
+        started_stages = set()
+        
+        try:
+            while remaining or running:
+                # Start every node whose dependencies are done, up to its stage's limit
+                for node_id, node in list(remaining.items()):
+                    if not all(dep in results for dep in node["deps"]):
+                        continue
+                    stage = node["stage"]
+                    limit = self.stage_limits.get(stage, self.default_limit)
+                    if stage_running.get(stage, 0) >= limit:
+                        continue
+                    if stage not in started_stages:
+                        started_stages.add(stage)
+                        if on_stage_start:
+                            await on_stage_start(stage)
+                    stage_running[stage] = stage_running.get(stage, 0) + 1
+                    running[asyncio.ensure_future(node["func"](results))] = node_id
+                    del remaining[node_id]
+                
+                if not running:
+                    raise ValueError(f"Pipeline has unsatisfiable dependencies: {list(remaining)}")
+                
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    node_id = running.pop(task)
+                    stage_running[self.nodes[node_id]["stage"]] -= 1
+                    results[node_id] = task.result()
+                    if on_complete:
+                        await on_complete(node_id, results[node_id])
+        finally:
+            # Don't leave nodes running if the pipeline failed or was cancelled
+            for task in running:
+                task.cancel()
+        
+        return results
+
+# Deadline mode for fast messages, off unless a message sends a deadline (or FAST_DEADLINE is set): integration starts
+# deadline seconds after the regions start, or FAST_QUORUM_GRACE seconds after FAST_QUORUM (a fraction) of them have
+# answered, whichever comes first, but never before one region has answered. Regions still thinking then are
+# cancelled and reported as dropped. FAST_QUORUM only applies in deadline mode; None disables it.
+FAST_DEADLINE = None
+FAST_QUORUM = None
+FAST_QUORUM_GRACE = 1.0
+# In fast mode, have one Prefrontal call integrate the regions and answer the user, instead of an integration call
+# followed by a response call
+SINGLE_PASS_INTEGRATION = False
+# Ask for every region's first thought in one call returning a JSON object keyed by region, instead of one call per
+# region; regions the reply misses (or that run on their own model) still get individual calls
+BATCH_REGIONS = False
+
+# Models that replace the chat's model for particular regions (and "Router" for routing), so peripheral regions can
+# run on a small fast model, e.g. {"Brainstem": "llama3.2:1b", "Hypothalamus": "llama3.2:1b", "Router": "llama3.2:1b"}.
+# The Prefrontal Cortex integrates and writes the final response, so leave it on the chat's model.
+REGION_MODELS = {}
+
 class BrainSystem:
-    def __init__(self, api_url, model):
+    def __init__(self, api_url, model, client=None, cache=None, memory=None, region_models=None):
         self.api_url = api_url
         self.model = model
+        self.client = client or async_ollama_client
+        self.cache = cache or response_cache
+        self.memory = memory or get_memory_store()
+        self.region_models = REGION_MODELS if region_models is None else region_models
         self.agents = self.initialize_agents()
+        for name, agent in self.agents.items():
+            agent.model = self.region_models.get(name, model)
         self.conversation_history = []
         regions_info = {name: agent.role for name, agent in self.agents.items()}
-        self.router = RouterAgent(api_url, model)
+        self.local_router = LocalRouter(regions_info)
+        self.router = RouterAgent(api_url, self.region_models.get("Router", model), self.client, self.cache, self.local_router.score)
+        self.stage_concurrency = dict(STAGE_CONCURRENCY)
         
     def initialize_agents(self):
         agents = {
@@ -167,108 +1764,271 @@ class BrainSystem:
                 "Prefrontal Cortex", 
                 "Executive function, decision-making, planning, working memory, impulse control, and coordination of other brain regions. As the supervisor agent, you integrate information from all regions and make final decisions. All outputs to the user should be in FIRST person",
                 self.api_url,
-                self.model
+                self.model,
+                self.client,
+                self.cache
             ),
             "Amygdala": BrainAgent(
                 "Amygdala", 
                 "Emotional processing, especially fear, anxiety, happiness, and threat detection. You evaluate emotional significance and generate emotional responses. Critical for survival responses and emotional memory.",
                 self.api_url,
-                self.model
+                self.model,
+                self.client,
+                self.cache
             ),
             "Hippocampus": BrainAgent(
                 "Hippocampus", 
                 "Memory formation, storage, and retrieval. You connect current input with past experiences and knowledge. You create new memories and retrieve relevant ones.",
                 self.api_url,
-                self.model
+                self.model,
+                self.client,
+                self.cache
             ),
             "Temporal Lobe": BrainAgent(
                 "Temporal Lobe", 
                 "Processing of auditory information, language comprehension, and semantic memory. You help understand meaning, recognize objects, faces, and sounds.",
                 self.api_url,
-                self.model
+                self.model,
+                self.client,
+                self.cache
             ),
             "Parietal Lobe": BrainAgent(
                 "Parietal Lobe", 
                 "Spatial awareness, sensory integration, and attention. You help understand relationships between objects and concepts, interpret sensory information, and maintain body awareness.",
                 self.api_url,
-                self.model
+                self.model,
+                self.client,
+                self.cache
             ),
             "Occipital Lobe": BrainAgent(
                 "Occipital Lobe", 
                 "Visual processing and interpretation. You analyze visual information, imagery, colors, motion, and help form visual memories.",
                 self.api_url,
-                self.model
+                self.model,
+                self.client,
+                self.cache
             ),
             "Cerebellum": BrainAgent(
                 "Cerebellum", 
                 "Motor coordination, precision, timing, and some cognitive functions. You ensure smooth processing, sequence learning, and contribute to emotional regulation.",
                 self.api_url,
-                self.model
+                self.model,
+                self.client,
+                self.cache
             ),
             "Broca's Area": BrainAgent(
                 "Broca's Area", 
                 "Speech production and language processing. You help formulate grammatically correct responses, coordinate muscle movements for speech, and assist with language comprehension.",
                 self.api_url,
-                self.model
+                self.model,
+                self.client,
+                self.cache
             ),
             "Wernicke's Area": BrainAgent(
                 "Wernicke's Area", 
                 "Language comprehension, connecting words with meaning. You help understand the semantic content of input, interpret language, and support language-based reasoning.",
                 self.api_url,
-                self.model
+                self.model,
+                self.client,
+                self.cache
             ),
             "Anterior Cingulate Cortex": BrainAgent(
                 "Anterior Cingulate Cortex", 
                 "Error detection, conflict monitoring, and attention regulation. You highlight inconsistencies and uncertainties, help with decision-making, and regulate emotional responses.",
                 self.api_url,
-                self.model
+                self.model,
+                self.client,
+                self.cache
             ),
             "Thalamus": BrainAgent(
                 "Thalamus", 
                 "Sensory relay, filtering, and attention regulation. You decide what information reaches consciousness, relay sensory signals, and help regulate sleep/wake cycles.",
                 self.api_url,
-                self.model
+                self.model,
+                self.client,
+                self.cache
             ),
             "Hypothalamus": BrainAgent(
                 "Hypothalamus", 
                 "Regulation of basic drives, emotional states, and homeostasis. You signal basic motivations like hunger, thirst, temperature regulation, and influence hormone release.",
                 self.api_url,
-                self.model
+                self.model,
+                self.client,
+                self.cache
             ),
             "Basal Ganglia": BrainAgent(
                 "Basal Ganglia", 
                 "Action selection, habit formation, and procedural learning. You help choose appropriate behaviors and responses, facilitate movement initiation, and support reward-based learning.",
                 self.api_url,
-                self.model
+                self.model,
+                self.client,
+                self.cache
             ),
             "Brainstem": BrainAgent(
                 "Brainstem", 
                 "Basic life functions, arousal, and alertness. You regulate breathing, heart rate, sleep cycles, and consciousness levels, forming the most primitive part of the brain.",
                 self.api_url,
-                self.model
+                self.model,
+                self.client,
+                self.cache
             ),
             "Insula": BrainAgent(
                 "Insula", 
                 "Interoception, awareness of bodily states, and social emotions. You sense internal feelings, contribute to empathy, emotional awareness, and help process disgust and pain.",
                 self.api_url,
-                self.model
+                self.model,
+                self.client,
+                self.cache
             )
         }
         return agents
     
     # Helper method to process a single region (for parallel processing)
-    def process_region(self, name, agent, context, user_input, thoughts, fast_mode):
-        thought = agent.think(context, user_input, fast_mode)
-        thoughts[name] = thought
+    async def process_region(self, name, agent, context, user_input, fast_mode, on_token=None, budget=None):
+        thought = await agent.think_async(context, user_input, fast_mode, on_token, budget)
         return name, thought
 
-    def process_input(self, user_input, verbose=False, fast_thinking=False):
-        # Get a dictionary of brain regions and their roles
-        regions_info = {name: agent.role for name, agent in self.agents.items()}
+    def route(self, user_input, regions_info, fast_thinking=False, router_mode=DEFAULT_ROUTER_MODE, budget=None):
+        return async_runner.run(self.route_async(user_input, regions_info, fast_thinking, router_mode, budget))
+    
+    async def route_async(self, user_input, regions_info, fast_thinking=False, router_mode=DEFAULT_ROUTER_MODE, budget=None):
+        selection = await self.select_regions_async(user_input, regions_info, fast_thinking, router_mode, budget)
+        return self.router.prune_selection(selection, user_input, fast_thinking)
+    
+    async def select_regions_async(self, user_input, regions_info, fast_thinking=False, router_mode=DEFAULT_ROUTER_MODE, budget=None):
+        # "llm" asks the model, "local" scores regions by TF-IDF, "hybrid" asks the model only when the local score is weak
+        if router_mode in ("local", "hybrid"):
+            selection, confidence = self.local_router.select(user_input, regions_info, fast_thinking)
+            if router_mode == "hybrid" and confidence < LOCAL_ROUTER_CONFIDENCE:
+                return await self.router.determine_relevant_regions_async(user_input, regions_info, fast_thinking, budget)
+            if confidence <= 0:
+                return self.router.get_essential_regions(regions_info)
+            return selection
+        return await self.router.determine_relevant_regions_async(user_input, regions_info, fast_thinking, budget)
+
+    def recall(self, user_input, session_id=None):
+        # Relevant past exchanges and documents, formatted as context for the memory regions
+        memories = self.memory.search(user_input, session_id=session_id)
+        return "\n".join(f"- {record['text']}" for _, record in memories)
+    
+    def process_input(self, user_input, verbose=False, fast_thinking=False, stream=False, room=None, history=None,
+                      router_mode=DEFAULT_ROUTER_MODE, session_id=None, deadline=FAST_DEADLINE,
+                      single_pass=SINGLE_PASS_INTEGRATION, batched=BATCH_REGIONS, timings=False):
+        return async_runner.run(self.process_input_async(
+            user_input, verbose, fast_thinking, stream, room, history, router_mode, session_id,
+            deadline=deadline, single_pass=single_pass, batched=batched, timings=timings
+        ))
+    
+    def build_batch_prompt(self, names, context, user_input, fast_mode=False):
+        regions = "\n".join(f"- {name}: {self.agents[name].role}" for name in names)
+        length = "1-2 sentences" if fast_mode else "2-5 sentences"
+        return f"""
+Input: {user_input}
+
+Context: {context}
+
+You are several parts of a human brain, each processing the input above from its own perspective.
+
+Regions:
+{regions}
+
+For each region, give a brief response ({length}) from the perspective of that region.
+Respond with only a JSON object keyed by region name, with each region's response as a string.
+"""
+    
+    async def warm_up_async(self):
+        # Load every model this brain uses
+        models = {agent.model for agent in self.agents.values()} | {self.router.model}
+        await asyncio.gather(*[self.client.warm_up(self.api_url, model) for model in models])
+    
+    def batchable_regions(self, names):
+        # Only regions on the chat's model can share a batched call
+        return [name for name in names if self.agents[name].model == self.model]
+    
+    async def think_batch_async(self, names, context, user_input, fast_mode=False, budget=None):
+        # One call thinks for all the given regions; returns the thoughts it could parse
+        budget = budget or PromptBudget()
+        prompt = self.build_batch_prompt(names, context, user_input, fast_mode)
+        
+        overflow = estimate_tokens(prompt) - budget.limit("think")
+        compacted = []
+        if overflow > 0 and context:
+            context = truncate_to_tokens(context, estimate_tokens(context) - overflow)
+            prompt = self.build_batch_prompt(names, context, user_input, fast_mode)
+            compacted.append("truncated_context")
+        budget.record("think", "Batch", prompt, compacted)
+        
+        cache_key = self.cache.make_key(self.model, "Batch", "fast" if fast_mode else "full", prompt)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            return dict(cached)
+        
+        payload = {
+            "model": self.model,
+            "prompt": prompt,
+            "stream": False,
+            "format": {
+                "type": "object",
+                "properties": {name: {"type": "string"} for name in names},
+                "required": names
+            }
+        }
+        try:
+            labels = {"region": "Batch", "mode": "fast" if fast_mode else "full"}
+            response_text = strip_reasoning((await self.client.generate(self.api_url, payload, "batch", labels)).get('response', ''))
+            raw = json.loads(response_text[response_text.find('{'):response_text.rfind('}') + 1])
+        except Exception:
+            return {}
+        if not isinstance(raw, dict):
+            return {}
+        
+        thoughts = {}
+        for name in names:
+            thought = raw.get(name)
+            if isinstance(thought, str) and thought.strip():
+                thoughts[name] = thought.strip()
+        if len(thoughts) == len(names):
+            self.cache.set(cache_key, thoughts)
+        return thoughts
+    
+    async def process_input_async(self, user_input, verbose=False, fast_thinking=False, stream=False, room=None,
+                                  history=None, router_mode=DEFAULT_ROUTER_MODE, session_id=None, emit=None,
+                                  deadline=FAST_DEADLINE, single_pass=SINGLE_PASS_INTEGRATION, batched=BATCH_REGIONS,
+                                  timings=False, checkpoint=None):
+        # Callers that keep their own per-session history pass it in; otherwise use this brain's own
+        keep_history = history is None
+        if keep_history:
+            history = self.conversation_history
+        
+        # Send events only to the requesting client's room (or everyone if no room was given).
+        # The async server passes its own emit coroutine; otherwise events go out through Flask-SocketIO.
+        if emit is None:
+            async def emit(event, data):
+                socketio.emit(event, data, to=room)
+        
+        # Get a dictionary of brain regions and their roles
+        regions_info = {name: agent.role for name, agent in self.agents.items()}
         
         # Determine which brain regions to activate
-        socketio.emit('processing_update', {'message': 'Routing input to relevant brain regions...'})
-        active_regions = self.router.determine_relevant_regions(user_input, regions_info, fast_thinking)
+        await emit('processing_update', {'message': 'Routing input to relevant brain regions...'})
+        # Measures (and bounds) every prompt sent for this message
+        budget = PromptBudget()
+        # Times each stage and Ollama call of this message (sent back in processing_complete when timings is set)
+        trace = MessageTrace("fast" if fast_thinking else "full")
+        current_trace.set(trace)
+        # A resumed job (checkpoint is its JobCheckpoints) reuses the routing and thoughts saved before it was interrupted
+        saved = checkpoint.saved if checkpoint else {}
+        async def save(key, value):
+            # Failed thoughts aren't kept, so a resumed job retries them
+            if checkpoint and not (isinstance(value, str) and value.startswith("Error:")):
+                await checkpoint.save(key, value)
+        
+        with trace.stage('route'):
+            if 'route' in saved:
+                active_regions = dict(saved['route'])
+            else:
+                active_regions = await self.route_async(user_input, regions_info, fast_thinking, router_mode, budget)
+                await save('route', active_regions)
         
         # Force Prefrontal Cortex to always be active
         active_regions["Prefrontal Cortex"] = 1
@@ -281,250 +2041,453 @@ class BrainSystem:
         
         # Log which regions are active
         active_region_names = [name for name, value in active_regions.items() if value == 1]
-        socketio.emit('processing_update', {
+        await emit('processing_update', {
             'message': f'Activating regions: {", ".join(active_region_names)}',
             'active_regions': active_region_names
         })
         
         # Store thoughts from each region
         thoughts = {}
+        # Regions cancelled for missing the fast-mode deadline
+        dropped_regions = []
+        
+        # Only the top few relevant memories are recalled, so the prompt doesn't grow with history
+        with trace.stage('recall'):
+            memories = await asyncio.to_thread(self.recall, user_input, session_id)
+        def region_context(name, context):
+            if memories and name in MEMORY_CONTEXT_REGIONS:
+                return f"{context}\nRelevant memories:\n{memories}"
+            return context
+        
+        def batch_context(names, context):
+            # A batched prompt is shared, so it carries the memories if any of its regions would receive them
+            for name in names:
+                if name in MEMORY_CONTEXT_REGIONS:
+                    return region_context(name, context)
+            return context
         
         # Calculate total active regions correctly
         total_active = sum(1 for value in active_regions.values() if value == 1)
         
+        # When streaming, forward partial tokens for a thought (only shown in verbose mode)
+        def thought_tokens(stream_id, region):
+            if not (stream and verbose):
+                return None
+            return lambda token: emit('thought_token', {
+                'region': region,
+                'stream_id': stream_id,
+                'token': token
+            })
+        
+        # When streaming, forward partial tokens of the final response
+        response_tokens = None
+        if stream:
+            response_tokens = lambda token: emit('response_token', {'token': token})
+        
         # In fast mode, skip intermediate steps and process in parallel
         if fast_thinking:
-            # Process all active regions in parallel
-            with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-                futures = []
-                for name, agent in self.agents.items():
-                    if name != "Prefrontal Cortex" and active_regions.get(name, 0) == 1:
-                        futures.append(
-                            executor.submit(
-                                self.process_region, 
-                                name, 
-                                agent, 
-                                "Fast processing mode", 
-                                user_input, 
-                                {}, 
-                                True
-                            )
-                        )
-                
-                # Process and update as regions complete
-                processed_count = 0
-                total_active = sum(active_regions.values())
-                
-                for future in concurrent.futures.as_completed(futures):
+            processed_count = 0
+            total_active = sum(active_regions.values())
+            loop = asyncio.get_running_loop()
+            regions_started = loop.time()
+            cutoff = regions_started + deadline if deadline else None
+            
+            async def record_thought(name, thought):
+                thoughts[name] = thought
+                await save(f'fast:{name}', thought)
+                if verbose:
+                    await emit('brain_thought', {
+                        'region': name,
+                        'thought': thought,
+                        'stream_id': f'fast:{name}',
+                        'active_regions': active_region_names
+                    })
+                else:
+                    await emit('processing_update', {
+                        'message': f'Fast thinking... ({processed_count}/{total_active-1})',
+                        'active_region': name
+                    })
+            
+            # Process active regions in parallel
+            tasks = {}
+            def start_region(name):
+                task = asyncio.create_task(
+                    self.process_region(
+                        name, 
+                        self.agents[name], 
+                        region_context(name, "Fast processing mode"), 
+                        user_input, 
+                        True,
+                        thought_tokens(f'fast:{name}', name),
+                        budget
+                    )
+                )
+                tasks[task] = name
+            
+            # In batched mode one call (within the deadline) thinks for the regions on the chat's model, while the
+            # others start right away; regions missing from the batched reply get their own call afterwards
+            region_names = [name for name in self.agents if name != "Prefrontal Cortex" and active_regions.get(name, 0) == 1]
+            for name in region_names:
+                if f'fast:{name}' in saved:
                     processed_count += 1
-                    name, thought = future.result()
-                    thoughts[name] = thought
-                    
-                    if verbose:
-                        socketio.emit('brain_thought', {
-                            'region': name,
-                            'thought': thought,
-                            'active_regions': active_region_names
-                        })
+                    await record_thought(name, saved[f'fast:{name}'])
+            remaining = [name for name in region_names if f'fast:{name}' not in saved]
+            batch_names = self.batchable_regions(remaining) if batched else []
+            for name in remaining:
+                if name not in batch_names:
+                    start_region(name)
+            if batch_names:
+                try:
+                    batch = await asyncio.wait_for(
+                        self.think_batch_async(batch_names, batch_context(batch_names, "Fast processing mode"), user_input, True, budget),
+                        deadline
+                    )
+                except asyncio.TimeoutError:
+                    batch = {}
+                for name in batch_names:
+                    if name in batch:
+                        processed_count += 1
+                        await record_thought(name, batch[name])
                     else:
-                        socketio.emit('processing_update', {
-                            'message': f'Fast thinking... ({processed_count}/{total_active-1})',
-                            'active_region': name
-                        })
+                        start_region(name)
+            
+            # Process and update as regions complete, until the deadline or shortly after a quorum has answered
+            if deadline and FAST_QUORUM is not None:
+                quorum = math.ceil(FAST_QUORUM * len(region_names))
+            else:
+                quorum = len(region_names)
+            pending = set(tasks)
+            
+            def answered():
+                return any(not thought.startswith("Error:") for thought in thoughts.values())
+            
+            try:
+                while pending:
+                    # Past the cutoff, keep waiting until there is at least one thought to integrate
+                    timeout = None if cutoff is None or not answered() else cutoff - loop.time()
+                    if timeout is not None and timeout <= 0:
+                        break
+                    done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        processed_count += 1
+                        await record_thought(*task.result())
+                    
+                    if processed_count >= quorum and pending:
+                        grace_end = loop.time() + FAST_QUORUM_GRACE
+                        cutoff = grace_end if cutoff is None else min(cutoff, grace_end)
+            finally:
+                # Cancel the stragglers so their backend slots are freed for other requests
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+            
+            dropped_regions = [tasks[task] for task in pending]
+            trace.record_stage('regions', loop.time() - regions_started)
+            if dropped_regions:
+                await emit('processing_update', {
+                    'message': f'Continuing without slow regions: {", ".join(dropped_regions)}'
+                })
             
             # Compile all thoughts for the Prefrontal Cortex
             context = "\n".join([f"{name}: {thought}" for name, thought in thoughts.items()])
             
             # Prefrontal Cortex integrates all inputs
             if verbose:
-                socketio.emit('processing_update', {'message': f'Fast integration in Prefrontal Cortex...'})
+                await emit('processing_update', {'message': f'Fast integration in Prefrontal Cortex...'})
             else:
-                socketio.emit('processing_update', {
+                await emit('processing_update', {
                     'message': f'Finalizing... ({total_active}/{total_active})',
                     'active_region': 'Prefrontal Cortex'
                 })
             
-            # Single step prefrontal processing in fast mode
-            prefrontal_thought = self.agents["Prefrontal Cortex"].think(context, user_input, True)
-            thoughts["Prefrontal Cortex"] = prefrontal_thought
-            
-            if verbose:
-                socketio.emit('brain_thought', {
-                    'region': 'Prefrontal Cortex',
-                    'thought': prefrontal_thought,
-                    'active_regions': active_region_names
-                })
+            if single_pass:
+                # One Prefrontal call integrates the thoughts and answers the user; its answer is also its thought
+                with trace.stage('response'):
+                    response = await self.generate_response_async(user_input, thoughts, {}, None, active_region_names, fast_thinking, response_tokens, history, budget)
+                if verbose:
+                    await emit('brain_thought', {
+                        'region': 'Prefrontal Cortex',
+                        'thought': response,
+                        'stream_id': 'fast:Prefrontal Cortex',
+                        'active_regions': active_region_names
+                    })
+            else:
+                # Single step prefrontal processing in fast mode
+                with trace.stage('integration'):
+                    prefrontal_thought = saved.get('fast:Prefrontal Cortex') or await self.agents["Prefrontal Cortex"].think_async(
+                        region_context("Prefrontal Cortex", context), user_input, True, thought_tokens('fast:Prefrontal Cortex', 'Prefrontal Cortex'), budget
+                    )
+                thoughts["Prefrontal Cortex"] = prefrontal_thought
+                await save('fast:Prefrontal Cortex', prefrontal_thought)
                 
-            # Skip second round in fast mode and generate final response directly
-            response = self.generate_response(user_input, thoughts, {}, prefrontal_thought, active_region_names, fast_thinking)
+                if verbose:
+                    await emit('brain_thought', {
+                        'region': 'Prefrontal Cortex',
+                        'thought': prefrontal_thought,
+                        'stream_id': 'fast:Prefrontal Cortex',
+                        'active_regions': active_region_names
+                    })
+                    
+                # Skip second round in fast mode and generate final response directly
+                with trace.stage('response'):
+                    response = await self.generate_response_async(user_input, thoughts, {}, prefrontal_thought, active_region_names, fast_thinking, response_tokens, history, budget)
             
         else:
-            # Original slower processing with more steps
-            processed_count = 0
+            # Full processing as a DAG: round one -> Prefrontal integration -> round two -> final integration -> response
+            region_names = [name for name in self.agents if name != "Prefrontal Cortex" and active_regions.get(name, 0) == 1]
             total_active = sum(active_regions.values())
+            progress = {"round1": 0, "round2": 0}
             
-            # First round: Initial responses from all active regions except Prefrontal Cortex
-            for name, agent in self.agents.items():
-                if name != "Prefrontal Cortex" and active_regions.get(name, 0) == 1:
-                    processed_count += 1
+            def round_one(name):
+                async def think(results):
+                    # Use the batched thought when the batch call produced one
+                    if name in results.get('batch', {}):
+                        return results['batch'][name]
+                    return await self.agents[name].think_async(
+                        region_context(name, "Initial processing"), user_input, False, thought_tokens(f'round1:{name}', name), budget
+                    )
+                return think
+            
+            async def integrate(results):
+                context = "\n".join([f"{name}: {results[('round1', name)]}" for name in region_names])
+                return await self.agents["Prefrontal Cortex"].think_async(
+                    region_context("Prefrontal Cortex", context), user_input, False, thought_tokens('integration', 'Prefrontal Cortex'), budget
+                )
+            
+            def round_two(name):
+                async def refine(results):
+                    updated_context = f"Prefrontal Cortex's integration: {results['integration']}\nYour previous thought: {results[('round1', name)]}"
+                    return await self.agents[name].think_async(
+                        updated_context, user_input, False, thought_tokens(f'round2:{name}', name), budget
+                    )
+                return refine
+            
+            async def final_integration(results):
+                final_context = "\n".join([f"{name}: {results[('round2', name)]}" for name in region_names])
+                return await self.agents["Prefrontal Cortex"].think_async(
+                    f"Your previous integration: {results['integration']}\nUpdated context from brain regions:\n{final_context}", 
+                    user_input,
+                    False,
+                    thought_tokens('final', 'Prefrontal Cortex'),
+                    budget
+                )
+            
+            async def final_response(results):
+                first_round = {name: results[('round1', name)] for name in region_names}
+                first_round["Prefrontal Cortex"] = results['integration']
+                second_round = {name: results[('round2', name)] for name in region_names}
+                return await self.generate_response_async(user_input, first_round, second_round, results['final'], active_region_names, fast_thinking, response_tokens, history, budget)
+            
+            def resumable(key, node):
+                # Reuse the node's thought from an interrupted run of this job, and save a new one
+                async def run(results):
+                    if key in saved:
+                        return saved[key]
+                    thought = await node(results)
+                    await save(key, thought)
+                    return thought
+                return run
+            
+            scheduler = PipelineScheduler(self.stage_concurrency)
+            # In batched mode round one waits on one call for the regions on the chat's model
+            batch_names = self.batchable_regions([name for name in region_names if f'round1:{name}' not in saved]) if batched else []
+            if batch_names:
+                scheduler.add_node('batch', lambda results: self.think_batch_async(
+                    batch_names, batch_context(batch_names, "Initial processing"), user_input, False, budget
+                ), stage='round1')
+            for name in region_names:
+                scheduler.add_node(('round1', name), resumable(f'round1:{name}', round_one(name)), ['batch'] if name in batch_names else [], stage='round1')
+            scheduler.add_node('integration', resumable('integration', integrate), [('round1', name) for name in region_names], stage='integration')
+            for name in region_names:
+                scheduler.add_node(('round2', name), resumable(f'round2:{name}', round_two(name)), ['integration', ('round1', name)], stage='round2')
+            scheduler.add_node('final', resumable('final', final_integration), [('round2', name) for name in region_names] + ['integration'], stage='final')
+            scheduler.add_node('response', final_response, ['final'], stage='response')
+            
+            # Each stage is timed from its first node starting until its last node finishes
+            stage_started = {}
+            stage_left = {}
+            for node in scheduler.nodes.values():
+                stage_left[node["stage"]] = stage_left.get(node["stage"], 0) + 1
+            
+            async def on_stage_start(stage):
+                stage_started[stage] = time.perf_counter()
+                if stage == 'round1' and verbose:
+                    await emit('processing_update', {'message': f'Processing in {len(region_names)} regions...'})
+                elif stage == 'integration':
                     if verbose:
-                        socketio.emit('processing_update', {'message': f'Processing in {name}...'})
+                        await emit('processing_update', {'message': 'Integrating in Prefrontal Cortex...'})
                     else:
-                        socketio.emit('processing_update', {
-                            'message': f'Thinking... ({processed_count}/{total_active})',
-                            'active_region': name
+                        await emit('processing_update', {
+                            'message': f'Thinking... ({total_active}/{total_active})',
+                            'active_region': 'Prefrontal Cortex'
                         })
-                    
-                    thought = agent.think("Initial processing", user_input)
-                    thoughts[name] = thought
-                    
+                elif stage == 'round2' and verbose:
+                    await emit('processing_update', {'message': 'Second round of processing with prefrontal feedback'})
+                elif stage == 'final':
+                    if verbose:
+                        await emit('processing_update', {'message': 'Final integration by Prefrontal Cortex'})
+                    else:
+                        await emit('processing_update', {
+                            'message': 'Finalizing response...',
+                            'active_region': 'Prefrontal Cortex'
+                        })
+                elif stage == 'response':
                     if verbose:
-                        socketio.emit('brain_thought', {
+                        await emit('processing_update', {'message': 'Generating final response'})
+                    else:
+                        await emit('processing_update', {
+                            'message': 'Generating response...',
+                            'active_region': 'Prefrontal Cortex'
+                        })
+            
+            async def on_node_complete(node, thought):
+                stage = scheduler.nodes[node]["stage"]
+                stage_left[stage] -= 1
+                if not stage_left[stage]:
+                    trace.record_stage(stage, time.perf_counter() - stage_started[stage])
+                if isinstance(node, tuple):
+                    stage, name = node
+                    progress[stage] += 1
+                    if stage == 'round1':
+                        thoughts[name] = thought
+                    if verbose:
+                        await emit('brain_thought', {
                             'region': name,
                             'thought': thought,
+                            'stream_id': f'{stage}:{name}',
                             'active_regions': active_region_names
                         })
-                    
-                    # Simulate processing time
-                    time.sleep(0.5)
-            
-            # Compile all thoughts for the Prefrontal Cortex
-            context = "\n".join([f"{name}: {thought}" for name, thought in thoughts.items()])
-            
-            # Prefrontal Cortex integrates all inputs
-            if verbose:
-                socketio.emit('processing_update', {'message': f'Integrating in Prefrontal Cortex...'})
-            else:
-                socketio.emit('processing_update', {
-                    'message': f'Thinking... ({total_active}/{total_active})',
-                    'active_region': 'Prefrontal Cortex'
-                })
-            
-            prefrontal_thought = self.agents["Prefrontal Cortex"].think(context, user_input)
-            thoughts["Prefrontal Cortex"] = prefrontal_thought
-            
-            if verbose:
-                socketio.emit('brain_thought', {
-                    'region': 'Prefrontal Cortex',
-                    'thought': prefrontal_thought,
-                    'active_regions': active_region_names
-                })
-            
-            # Second round: Regions respond to Prefrontal's initial integration
-            updated_thoughts = {}
-            if verbose:
-                socketio.emit('processing_update', {'message': 'Second round of processing with prefrontal feedback'})
-            
-            processed_count = 0
-            for name, agent in self.agents.items():
-                if name != "Prefrontal Cortex" and active_regions.get(name, 0) == 1:
-                    processed_count += 1
-                    if verbose:
-                        socketio.emit('processing_update', {'message': f'Refining in {name}...'})
+                    elif stage == 'round1':
+                        await emit('processing_update', {
+                            'message': f'Thinking... ({progress[stage]}/{total_active})',
+                            'active_region': name
+                        })
                     else:
-                        socketio.emit('processing_update', {
-                            'message': f'Refining thought... ({processed_count}/{total_active-1})',
+                        await emit('processing_update', {
+                            'message': f'Refining thought... ({progress[stage]}/{total_active-1})',
                             'active_region': name
                         })
-                    
-                    updated_context = f"Prefrontal Cortex's integration: {prefrontal_thought}\nYour previous thought: {thoughts.get(name, '')}"
-                    updated_thought = agent.think(updated_context, user_input)
-                    updated_thoughts[name] = updated_thought
-                    
+                elif node in ('integration', 'final'):
+                    if node == 'integration':
+                        thoughts["Prefrontal Cortex"] = thought
                     if verbose:
-                        socketio.emit('brain_thought', {
-                            'region': name,
-                            'thought': updated_thought,
+                        await emit('brain_thought', {
+                            'region': 'Prefrontal Cortex',
+                            'thought': thought,
+                            'stream_id': node,
                             'active_regions': active_region_names
                         })
-                    
-                    # Simulate processing time
-                    time.sleep(0.5)
-            
-            # Final integration by Prefrontal Cortex
-            if verbose:
-                socketio.emit('processing_update', {'message': 'Final integration by Prefrontal Cortex'})
-            else:
-                socketio.emit('processing_update', {
-                    'message': 'Finalizing response...',
-                    'active_region': 'Prefrontal Cortex'
-                })
-            
-            final_context = "\n".join([f"{name}: {thought}" for name, thought in updated_thoughts.items()])
-            final_thought = self.agents["Prefrontal Cortex"].think(
-                f"Your previous integration: {prefrontal_thought}\nUpdated context from brain regions:\n{final_context}", 
-                user_input
-            )
-            
-            if verbose:
-                socketio.emit('brain_thought', {
-                    'region': 'Prefrontal Cortex',
-                    'thought': final_thought,
-                    'active_regions': active_region_names
-                })
-            
-            # Generate final response using all context
-            if verbose:
-                socketio.emit('processing_update', {'message': 'Generating final response'})
-            else:
-                socketio.emit('processing_update', {
-                    'message': 'Generating response...',
-                    'active_region': 'Prefrontal Cortex'
-                })
             
-            response = self.generate_response(user_input, thoughts, updated_thoughts, final_thought, active_region_names, fast_thinking)
+            results = await scheduler.run(on_node_complete, on_stage_start)
+            response = results['response']
         
-        # Add to conversation history
-        self.conversation_history.append({"user": user_input, "response": response})
+        # Learn which regions this answer drew on, so later routing can skip the ones that rarely help
+        self.router.learn(user_input, thoughts, response, fast_thinking, len(active_region_names) - 1)
+        
+        # Add to conversation history and long-term memory
+        if keep_history:
+            self.conversation_history.append({"user": user_input, "response": response})
+        with trace.stage('remember'):
+            await asyncio.to_thread(self.memory.add_exchange, user_input, response, session_id)
         
         # Signal completion
-        socketio.emit('processing_complete', {
+        completion = {
             'response': response,
-            'active_regions': []  # Clear active regions
-        })
+            'active_regions': [],  # Clear active regions
+            'dropped_regions': dropped_regions,
+            'prompt_sizes': budget.report()
+        }
+        breakdown = trace.finish()
+        if timings:
+            completion['timings'] = breakdown
+        await emit('processing_complete', completion)
         
         return response
     
-    def generate_response(self, user_input, thoughts, updated_thoughts, final_integration, active_regions, fast_thinking=False):
+    async def summarize_exchange(self, exchange, budget=None):
+        # Each exchange is summarized once; the summary is cached and reused on later turns
+        text = f"User: {exchange['user']}\nSystem: {exchange['response']}"
+        prompt = f"""
+Summarize this exchange from an ongoing conversation in one or two sentences, keeping names, facts and decisions:
+
+{truncate_to_tokens(text, PROMPT_BUDGETS["summary"] - 64)}
+
+Summary:
+"""
+        cache_key = self.cache.make_key(self.model, "History", "summary", text)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        if budget:
+            budget.record("summary", "History", prompt)
+        try:
+            response = await self.client.generate(
+                self.api_url, {"model": self.model, "prompt": prompt, "stream": False}, "summary", {"region": "History", "mode": "full"}
+            )
+            summary = strip_reasoning(response.get('response', ''))
+            self.cache.set(cache_key, summary)
+            return summary
+        except Exception:
+            pass
+        # Fall back to a plain cut if the summary call failed
+        return truncate_to_tokens(text, 96)
+    
+    def generate_response(self, user_input, thoughts, updated_thoughts, final_integration, active_regions, fast_thinking=False, on_token=None, history=None, budget=None):
+        return async_runner.run(self.generate_response_async(
+            user_input, thoughts, updated_thoughts, final_integration, active_regions, fast_thinking, on_token, history, budget
+        ))
+    
+    async def generate_response_async(self, user_input, thoughts, updated_thoughts, final_integration, active_regions, fast_thinking=False, on_token=None, history=None, budget=None):
+        budget = budget or PromptBudget()
+        limit = budget.limit("response")
+        compacted = []
+        
         # Compile all context - only include active regions
         active_thoughts = {name: thought for name, thought in thoughts.items() if name in active_regions or name == "Prefrontal Cortex"}
         
         # In fast mode, use simplified prompt with fewer steps
         if fast_thinking:
-            context = (
-                f"User input: {user_input}\n\n"
-                f"Brain processing:\n" + 
-                "\n".join([f"{name}: {thought}" for name, thought in active_thoughts.items()]) +
-                f"\n\nPrefrontal integration: {final_integration}"
-            )
-            
-            prompt = f"""
+            def build(initial, updated, history_context):
+                context = (
+                    f"User input: {user_input}\n\n"
+                    f"Brain processing:\n" + 
+                    "\n".join([f"{name}: {thought}" for name, thought in initial.items()])
+                )
+                
+                # Without a separate integration step, the Prefrontal Cortex integrates while it answers
+                if final_integration is None:
+                    return f"""
+As the Prefrontal Cortex, integrate these brain regions' processing and reply to the user directly in the FIRST person with a concise final response:
+{context}
+
+Final response:
+"""
+                return f"""
 Generate a concise final response based on these brain regions' processing:
 {context}
 
+Prefrontal integration: {final_integration}
+
 Final response:
 """
+            active_updated_thoughts = {}
+            history_context = ""
+            prompt = build(active_thoughts, active_updated_thoughts, history_context)
         else:
             active_updated_thoughts = {name: thought for name, thought in updated_thoughts.items() if name in active_regions or name == "Prefrontal Cortex"}
             
-            context = (
-                f"User input: {user_input}\n\n"
-                f"Initial brain processing:\n" + 
-                "\n".join([f"{name}: {thought}" for name, thought in active_thoughts.items()]) +
-                f"\n\nUpdated brain processing:\n" + 
-                "\n".join([f"{name}: {thought}" for name, thought in active_updated_thoughts.items()]) +
-                f"\n\nFinal integration by Prefrontal Cortex: {final_integration}"
-            )
-            
-            # Add conversation history for context if available
-            history_context = ""
-            if self.conversation_history:
-                history_context = "Previous conversation:\n" + "\n".join([
-                    f"User: {exchange['user']}\nSystem: {exchange['response']}" 
-                    for exchange in self.conversation_history[-3:] # Include last 3 exchanges
-                ])
+            def build(initial, updated, history_context):
+                context = (
+                    f"User input: {user_input}\n\n"
+                    f"Initial brain processing:\n" + 
+                    "\n".join([f"{name}: {thought}" for name, thought in initial.items()]) +
+                    f"\n\nUpdated brain processing:\n" + 
+                    "\n".join([f"{name}: {thought}" for name, thought in updated.items()]) +
+                    f"\n\nFinal integration by Prefrontal Cortex: {final_integration}"
+                )
                 
-            prompt = f"""
+                return f"""
 Based on the internal processing of all brain regions, generate a final response to the user.
 The response should be coherent, balanced, and reflect the integrated processing of all regions.
 
@@ -534,56 +2497,701 @@ The response should be coherent, balanced, and reflect the integrated processing
 
 Final response to user:
 """
+            
+            # Add conversation history for context if available
+            if history is None:
+                history = self.conversation_history
+            recent_history = history[-3:] # Include last 3 exchanges
+            history_context = ""
+            if recent_history:
+                history_context = "Previous conversation:\n" + "\n".join([
+                    f"User: {exchange['user']}\nSystem: {exchange['response']}" 
+                    for exchange in recent_history
+                ])
+            prompt = build(active_thoughts, active_updated_thoughts, history_context)
+            
+            # Over budget: first swap the history for per-exchange summaries
+            if estimate_tokens(prompt) > limit and recent_history:
+                summaries = await asyncio.gather(*[self.summarize_exchange(exchange, budget) for exchange in recent_history])
+                history_context = "Summary of previous conversation:\n" + "\n".join(f"- {summary}" for summary in summaries)
+                prompt = build(active_thoughts, active_updated_thoughts, history_context)
+                compacted.append("summarized_history")
+            
+            # Then keep only the round-two thoughts, which already build on round one
+            if estimate_tokens(prompt) > limit and active_updated_thoughts:
+                active_thoughts = {name: thought for name, thought in active_thoughts.items() if name == "Prefrontal Cortex"}
+                prompt = build(active_thoughts, active_updated_thoughts, history_context)
+                compacted.append("dropped_round_one")
+        
+        # Finally cut every remaining thought by the same proportion
+        overflow = estimate_tokens(prompt) - limit
+        if overflow > 0:
+            total = sum(estimate_tokens(thought) for thought in list(active_thoughts.values()) + list(active_updated_thoughts.values()))
+            if total:
+                ratio = max(0.0, (total - overflow) / total)
+                shrink = lambda group: {name: truncate_to_tokens(thought, int(estimate_tokens(thought) * ratio)) for name, thought in group.items()}
+                active_thoughts = shrink(active_thoughts)
+                active_updated_thoughts = shrink(active_updated_thoughts)
+                prompt = build(active_thoughts, active_updated_thoughts, history_context)
+                compacted.append("truncated_thoughts")
+        budget.record("response", "Response", prompt, compacted)
         
+        payload = {
+            "model": self.model,
+            "prompt": prompt,
+            "stream": False
+        }
+        
+        labels = {"region": "Response", "mode": "fast" if fast_thinking else "full"}
         try:
-            response = requests.post(
-                f"{self.api_url}/api/generate",
-                json={
-                    "model": self.model,
-                    "prompt": prompt,
-                    "stream": False
-                },
-                timeout=60
-            )
+            if on_token:
+                return (await self.client.stream_text(self.api_url, payload, "response", on_token, labels)).strip()
             
-            if response.status_code == 200:
-                final_response = response.json().get('response', '').strip()
-                return final_response
-            else:
-                return f"Error generating response: {response.status_code} - {response.text}"
-        except requests.exceptions.Timeout:
+            response = await self.client.generate(self.api_url, payload, "response", labels)
+            return strip_reasoning(response.get('response', ''))
+        except OllamaError as e:
+            return f"Error generating response: {str(e)}"
+        except asyncio.TimeoutError:
             return "I'm sorry, but it's taking longer than expected to process your request. Could you please try again?"
         except Exception as e:
             return f"I apologize, but something went wrong while processing your request: {str(e)}"
 
+# How many (api_url, model) brains to keep built at once
+BRAIN_REGISTRY_SIZE = 8
+
+class BrainRegistry:
+    def __init__(self, max_brains=BRAIN_REGISTRY_SIZE):
+        self.max_brains = max_brains
+        self.brains = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def get(self, api_url, model):
+        # Reuse the brain for this backend and model, building it only the first time it is needed
+        key = (api_url, model)
+        with self.lock:
+            brain = self.brains.get(key)
+            if brain is None:
+                brain = BrainSystem(api_url, model)
+                self.brains[key] = brain
+                while len(self.brains) > self.max_brains:
+                    self.brains.popitem(last=False)
+            else:
+                self.brains.move_to_end(key)
+            return brain
+
+# Limits for per-session conversation history
+CONVERSATION_MAX_SESSIONS = 1000
+CONVERSATION_MAX_EXCHANGES = 20
+CONVERSATION_TTL = 60 * 60
+CONVERSATION_MAX_BYTES = 32 * 1024 * 1024
+
+class ConversationStore:
+    def __init__(self, max_sessions=CONVERSATION_MAX_SESSIONS, max_exchanges=CONVERSATION_MAX_EXCHANGES,
+                 ttl=CONVERSATION_TTL, max_bytes=CONVERSATION_MAX_BYTES):
+        self.max_sessions = max_sessions
+        self.max_exchanges = max_exchanges
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # session_id -> {"history": [...], "size": bytes, "updated": timestamp}, least recently used first
+        self.sessions = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+    
+    def get(self, session_id):
+        # Return a copy of the session's history so callers can't grow it behind the store's back
+        with self.lock:
+            self.evict()
+            session = self.sessions.get(session_id)
+            if session is None:
+                return []
+            self.sessions.move_to_end(session_id)
+            return list(session["history"])
+    
+    def append(self, session_id, user_input, response):
+        exchange = {"user": user_input, "response": response}
+        with self.lock:
+            session = self.sessions.pop(session_id, None) or {"history": [], "size": 0}
+            self.total_bytes -= session["size"]
+            
+            session["history"].append(exchange)
+            del session["history"][:-self.max_exchanges]
+            session["size"] = sum(len(e["user"]) + len(e["response"]) for e in session["history"])
+            session["updated"] = time.time()
+            
+            self.sessions[session_id] = session
+            self.total_bytes += session["size"]
+            self.evict()
+    
+    def evict(self):
+        # Drop expired sessions, then least recently used ones until within the session and memory caps
+        now = time.time()
+        for session_id in [sid for sid, s in self.sessions.items() if now - s["updated"] > self.ttl]:
+            self.total_bytes -= self.sessions.pop(session_id)["size"]
+        while self.sessions and (len(self.sessions) > self.max_sessions or self.total_bytes > self.max_bytes):
+            _, session = self.sessions.popitem(last=False)
+            self.total_bytes -= session["size"]
+
+brain_registry = BrainRegistry()
+conversation_store = ConversationStore()
+
+# Number of chats processed at once and how many more may wait for a free worker
+CHAT_WORKERS = 4
+CHAT_QUEUE_SIZE = 32
+
+class ChatWorkerPool:
+    def __init__(self, num_workers=CHAT_WORKERS, queue_size=CHAT_QUEUE_SIZE):
+        self.num_workers = num_workers
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.outstanding = 0
+        self.lock = threading.Lock()
+        self.workers = []
+        for i in range(num_workers):
+            worker = threading.Thread(target=self.work, name=f"chat-worker-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+    
+    def submit(self, job):
+        # Returns the job's position in the waiting queue (0 if a worker is free), or raises queue.Full
+        with self.lock:
+            self.jobs.put_nowait((job, time.perf_counter()))
+            position = max(0, self.outstanding - self.num_workers + 1)
+            self.outstanding += 1
+        return position
+    
+    def depth(self):
+        return self.jobs.qsize()
+    
+    def work(self):
+        while True:
+            job, submitted = self.jobs.get()
+            metrics.observe("chat_queue_seconds", time.perf_counter() - submitted)
+            try:
+                job()
+            except Exception as e:
+                print(f"Chat job failed: {e}")
+            finally:
+                with self.lock:
+                    self.outstanding -= 1
+                self.jobs.task_done()
+
+chat_pool = ChatWorkerPool()
+
+# Multi-process mode (python main.py --processes): web workers serve the page, /chat and Socket.IO on consecutive
+# ports from WEB_PORT, and orchestration workers run the chats, CHAT_WORKERS at a time each. They share
+# MESSAGE_QUEUE for Socket.IO events (a redis:// or other Kombu URL, or sqlite:/// on a single machine) and
+# JOB_QUEUE_DB for waiting chats and conversation history
+WEB_WORKERS = 2
+ORCHESTRATION_WORKERS = 2
+WEB_PORT = 5000
+# Orchestration workers serve /metrics and the other stats routes on consecutive ports from ORCHESTRATOR_STATS_PORT,
+# since the Ollama calls, routing and limits they track never reach a web worker
+ORCHESTRATOR_STATS_PORT = 5100
+MESSAGE_QUEUE = "sqlite:///" + os.path.join(os.path.dirname(os.path.abspath(__file__)), "braingent-messages.db")
+# Every chat, in any mode, is a durable job in JOB_QUEUE_DB. Its events are kept so a client that reconnects can
+# catch up, and its region thoughts are checkpointed so a job interrupted by a restart resumes without redoing them
+JOB_QUEUE_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "braingent-jobs.db")
+# How often idle orchestration workers look for chats, and web workers for events, in seconds
+JOB_POLL_INTERVAL = 0.1
+MESSAGE_QUEUE_POLL_INTERVAL = 0.02
+# How long delivered events and finished jobs are kept, in seconds
+MESSAGE_QUEUE_RETENTION = 60
+JOB_RETENTION = 24 * 60 * 60
+# Workers mark their running jobs alive every JOB_HEARTBEAT seconds; a running job not heard from for
+# JOB_STALE_SECONDS is taken over by another orchestration worker
+JOB_HEARTBEAT = 10
+JOB_STALE_SECONDS = 60
+# Events replayed to reconnecting clients. Streamed tokens aren't kept: the brain_thought and processing_complete
+# events that follow them carry the full text
+JOB_REPLAY_EVENTS = ('processing_update', 'brain_thought', 'processing_complete')
+
+class SQLiteManager(PubSubManager):
+    # Socket.IO message queue in a SQLite file, so processes on one machine can share events without Redis
+    name = 'sqlite'
+    
+    def __init__(self, url=MESSAGE_QUEUE, channel='flask-socketio', write_only=False, logger=None,
+                 poll_interval=MESSAGE_QUEUE_POLL_INTERVAL, retention=MESSAGE_QUEUE_RETENTION):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.published = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(url[len('sqlite:///'):], timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT, data BLOB, created REAL)")
+        self.db.commit()
+    
+    def _publish(self, data):
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO messages (channel, data, created) VALUES (?, ?, ?)",
+                (self.channel, pickle.dumps(data), time.time())
+            )
+            self.published += 1
+            if self.published % 1000 == 0:
+                self.db.execute("DELETE FROM messages WHERE created < ?", (time.time() - self.retention,))
+            self.db.commit()
+    
+    def _listen(self):
+        # Every listener sees every message published by any process after it started
+        with self.lock:
+            last = self.db.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+        while True:
+            with self.lock:
+                rows = self.db.execute(
+                    "SELECT id, data FROM messages WHERE channel = ? AND id > ? ORDER BY id", (self.channel, last)
+                ).fetchall()
+            for last, data in rows:
+                yield data
+            if not rows:
+                time.sleep(self.poll_interval)
+
+def message_queue_manager(url=MESSAGE_QUEUE, write_only=False):
+    # The queues Flask-SocketIO accepts as message_queue, plus sqlite:///
+    if url.startswith('sqlite:///'):
+        return SQLiteManager(url, write_only=write_only)
+    if url.startswith(('redis://', 'rediss://')):
+        return RedisManager(url, channel='flask-socketio', write_only=write_only)
+    return KombuManager(url, channel='flask-socketio', write_only=write_only)
+
+class JobQueue:
+    # Every chat's status, result, events and checkpoints. In multi-process mode it is also the queue: web workers
+    # add chats and orchestration workers with a free slot claim the oldest
+    def __init__(self, path=JOB_QUEUE_DB, max_queued=CHAT_QUEUE_SIZE, slots=ORCHESTRATION_WORKERS * CHAT_WORKERS,
+                 retention=JOB_RETENTION, stale_seconds=JOB_STALE_SECONDS):
+        self.max_queued = max_queued
+        self.slots = slots
+        self.retention = retention
+        self.stale_seconds = stale_seconds
+        self.lock = threading.Lock()
+        # Autocommit, so transaction() controls when the write lock is taken
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, chat TEXT, status TEXT, worker TEXT, result TEXT, "
+            "created REAL, updated REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT, event TEXT, "
+            "data TEXT, created REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS events_job ON events (job_id, id)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS checkpoints (job_id TEXT, key TEXT, value TEXT, PRIMARY KEY (job_id, key))")
+    
+    @contextlib.contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two processes can never claim the same job
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+    
+    def insert(self, db, job_id, chat, status, worker=None):
+        now = time.time()
+        db.execute(
+            "INSERT INTO jobs (id, chat, status, worker, created, updated) VALUES (?, ?, ?, ?, ?, ?)",
+            (job_id, json.dumps(chat), status, worker, now, now)
+        )
+        # Forget finished jobs once they are old enough
+        expired = "SELECT id FROM jobs WHERE status IN ('done', 'failed') AND updated < ?"
+        for table in ("events", "checkpoints"):
+            db.execute(f"DELETE FROM {table} WHERE job_id IN ({expired})", (now - self.retention,))
+        db.execute(f"DELETE FROM jobs WHERE id IN ({expired})", (now - self.retention,))
+    
+    def create(self, job_id, chat, worker):
+        # A job this process runs itself; it waits as queued until one of its chat workers starts it
+        with self.transaction() as db:
+            self.insert(db, job_id, chat, 'queued', worker)
+    
+    def start(self, job_id, worker):
+        # A job claimed by an orchestration worker is already running
+        with self.lock:
+            self.db.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, updated = ? WHERE id = ? AND status = 'queued'",
+                (worker, time.time(), job_id)
+            )
+    
+    def discard(self, job_id):
+        # For a job that was never started
+        with self.lock:
+            self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+    
+    def submit(self, job_id, chat):
+        # Like ChatWorkerPool.submit, for orchestration workers: returns the chat's position among waiting chats, or
+        # raises queue.Full
+        with self.transaction() as db:
+            queued, running = db.execute(
+                "SELECT COALESCE(SUM(status = 'queued' AND worker IS NULL), 0), COALESCE(SUM(status = 'running'), 0) FROM jobs"
+            ).fetchone()
+            if queued >= self.max_queued:
+                raise queue.Full
+            self.insert(db, job_id, chat, 'queued')
+        return max(0, queued + running - self.slots + 1)
+    
+    def claim(self, worker):
+        # Returns (job id, chat, created timestamp) for the oldest waiting chat, or a running one whose worker has
+        # stopped sending heartbeats; None if there is neither. Chats queued by a single-process server are its own
+        stale = time.time() - self.stale_seconds
+        claimable = "(status = 'queued' AND worker IS NULL) OR (status = 'running' AND updated < ?)"
+        with self.lock:
+            if self.db.execute(f"SELECT 1 FROM jobs WHERE {claimable} LIMIT 1", (stale,)).fetchone() is None:
+                return None
+        with self.transaction() as db:
+            row = db.execute(f"SELECT id, chat, created FROM jobs WHERE {claimable} ORDER BY created LIMIT 1", (stale,)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE jobs SET status = 'running', worker = ?, updated = ? WHERE id = ?", (worker, time.time(), row[0]))
+        return row[0], json.loads(row[1]), row[2]
+    
+    def recover(self, worker):
+        # On startup of a single-process server, take over every job the previous run left unfinished; they wait as
+        # queued again until a chat worker starts them
+        with self.transaction() as db:
+            rows = db.execute("SELECT id, chat FROM jobs WHERE status IN ('queued', 'running') ORDER BY created").fetchall()
+            db.execute(
+                "UPDATE jobs SET status = 'queued', worker = ?, updated = ? WHERE status IN ('queued', 'running')",
+                (worker, time.time())
+            )
+        return [(job_id, json.loads(chat)) for job_id, chat in rows]
+    
+    def heartbeat(self, worker):
+        with self.lock:
+            self.db.execute("UPDATE jobs SET updated = ? WHERE status = 'running' AND worker = ?", (time.time(), worker))
+    
+    def finish(self, job_id, status, result=None):
+        with self.lock:
+            self.db.execute(
+                "UPDATE jobs SET status = ?, result = ?, updated = ? WHERE id = ?",
+                (status, json.dumps(result) if result is not None else None, time.time(), job_id)
+            )
+    
+    def record_event(self, job_id, event, data):
+        # Returns the event's id, which increases with every event
+        with self.lock:
+            return self.db.execute(
+                "INSERT INTO events (job_id, event, data, created) VALUES (?, ?, ?, ?)",
+                (job_id, event, json.dumps(data), time.time())
+            ).lastrowid
+    
+    def events(self, job_id, after=0):
+        # (event, data) for each event after the given id, with the job and event ids added to the data
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, event, data FROM events WHERE job_id = ? AND id > ? ORDER BY id", (job_id, after)
+            ).fetchall()
+        return [(event, dict(json.loads(data), job_id=job_id, event_id=event_id)) for event_id, event, data in rows]
+    
+    def checkpoint(self, job_id, key, value):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO checkpoints (job_id, key, value) VALUES (?, ?, ?)", (job_id, key, json.dumps(value))
+            )
+    
+    def checkpoints(self, job_id):
+        with self.lock:
+            rows = self.db.execute("SELECT key, value FROM checkpoints WHERE job_id = ?", (job_id,)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+    
+    def status(self, job_id):
+        with self.lock:
+            row = self.db.execute("SELECT status, result, created, updated FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        status, result, created, updated = row
+        return {
+            'job_id': job_id,
+            'status': status,
+            'created': created,
+            'updated': updated,
+            'result': json.loads(result) if result else None,
+            'checkpoints': self.checkpoints(job_id)
+        }
+    
+    def depth(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND worker IS NULL").fetchone()[0]
+
+class JobCheckpoints:
+    # One job's saved thoughts, loaded once when the job (re)starts
+    def __init__(self, store, job_id):
+        self.store = store
+        self.job_id = job_id
+        self.saved = store.checkpoints(job_id)
+    
+    async def save(self, key, value):
+        self.saved[key] = value
+        await asyncio.to_thread(self.store.checkpoint, self.job_id, key, value)
+
+class SharedConversationStore:
+    # ConversationStore kept in the job queue's database, since a session's chats may run on any orchestration worker
+    def __init__(self, path=JOB_QUEUE_DB, max_exchanges=CONVERSATION_MAX_EXCHANGES, ttl=CONVERSATION_TTL):
+        self.max_exchanges = max_exchanges
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS exchanges (id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT, "
+            "user TEXT, response TEXT, created REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS exchanges_session ON exchanges (session_id, id)")
+        self.db.commit()
+    
+    def get(self, session_id):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT user, response FROM exchanges WHERE session_id = ? AND created > ? ORDER BY id DESC LIMIT ?",
+                (session_id, time.time() - self.ttl, self.max_exchanges)
+            ).fetchall()
+        return [{"user": user, "response": response} for user, response in reversed(rows)]
+    
+    def append(self, session_id, user_input, response):
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO exchanges (session_id, user, response, created) VALUES (?, ?, ?, ?)",
+                (session_id, user_input, response, now)
+            )
+            self.db.execute(
+                "DELETE FROM exchanges WHERE created < ? OR (session_id = ? AND id NOT IN "
+                "(SELECT id FROM exchanges WHERE session_id = ? ORDER BY id DESC LIMIT ?))",
+                (now - self.ttl, session_id, session_id, self.max_exchanges)
+            )
+            self.db.commit()
+
+class SharedMemoryStore(MemoryStore):
+    # MemoryStore kept in the job queue's database, since the memory files in MEMORY_DIR can't be written by several
+    # processes at once. Each process keeps its own index and catches up on the memories others added before searching
+    def __init__(self, embedder=None, path=JOB_QUEUE_DB):
+        super().__init__(embedder, directory=None)
+        self.synced = 0
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS memories (id INTEGER PRIMARY KEY AUTOINCREMENT, record TEXT, vector BLOB)")
+        self.db.commit()
+    
+    def append(self, records, vectors):
+        self.db.executemany(
+            "INSERT INTO memories (record, vector) VALUES (?, ?)",
+            [(json.dumps(record), vector.tobytes()) for record, vector in zip(records, vectors)]
+        )
+        self.db.commit()
+        # Picks up these records too, so every process indexes memories in the same order
+        self.refresh()
+    
+    def refresh(self):
+        rows = self.db.execute("SELECT id, record, vector FROM memories WHERE id > ? ORDER BY id", (self.synced,)).fetchall()
+        if rows:
+            self.synced = rows[-1][0]
+            vectors = np.stack([np.frombuffer(vector, dtype=np.float32) for _, _, vector in rows])
+            super().append([json.loads(record) for _, record, _ in rows], vectors)
+
+# Opened by get_job_store on first use, so importing this module doesn't create JOB_QUEUE_DB
+job_store = None
+job_store_lock = threading.Lock()
+
+def get_job_store():
+    global job_store
+    with job_store_lock:
+        if job_store is None:
+            job_store = JobQueue()
+        return job_store
+
+# Names this process in the job store, as the worker running its jobs
+worker_id = f"{socket.gethostname()}-{os.getpid()}"
+# Set in web workers, whose /chat hands chats to the orchestration workers instead of chat_pool
+dispatch_jobs = False
+
+def job_room(job_id):
+    # A job's events go to its own room, which the client rejoins after reconnecting
+    return f"job:{job_id}"
+
 # Flask routes
 @app.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/chat', methods=['POST'])
-def chat():
-    data = request.json
-    user_input = data.get('message', '')
-    verbose = data.get('verbose', False)
-    fast_thinking = data.get('fastThinking', False)
+def parse_chat_request(data):
+    # Returns the chat's settings, or an error message for an invalid request
+    chat = {
+        'message': data.get('message', ''),
+        'verbose': data.get('verbose', False),
+        'fast_thinking': data.get('fastThinking', False),
+        'stream': data.get('stream', False),
+        # Socket.IO session id of the browser that sent the message, so only it receives the updates
+        'room': data.get('sid'),
+        'router_mode': data.get('router', DEFAULT_ROUTER_MODE),
+        # Fast-mode latency budget in seconds for this message
+        'deadline': data.get('deadline', FAST_DEADLINE),
+        'single_pass': data.get('singlePass', SINGLE_PASS_INTEGRATION),
+        'batched': data.get('batched', BATCH_REGIONS),
+        # Include a per-stage and per-call timing breakdown in processing_complete
+        'timings': data.get('timings', False)
+    }
+    # Conversation history is kept per browser session, falling back to the socket id
+    chat['session_id'] = data.get('session_id') or chat['room']
+    if chat['router_mode'] not in ROUTER_MODES:
+        return None, f"Unknown router mode: {chat['router_mode']}"
+    deadline = chat['deadline']
+    if deadline is not None and (isinstance(deadline, bool) or not isinstance(deadline, (int, float)) or deadline <= 0):
+        return None, f"Invalid deadline: {deadline}"
     
     # Get Ollama configuration
     ollama_config = data.get('ollama', {})
-    api_url = ollama_config.get('api_url', "http://localhost:11434")
-    model = ollama_config.get('model', "neural-chat")
+    chat['api_url'] = ollama_config.get('api_url', "http://localhost:11434")
+    chat['model'] = ollama_config.get('model', "neural-chat")
+    return chat, None
+
+async def run_chat(chat, emit=None, conversations=None, checkpoint=None):
+    # Reuse the brain built for these Ollama settings
+    brain = brain_registry.get(chat['api_url'], chat['model'])
+    session_id = chat['session_id']
+    conversations = conversations or conversation_store
+    try:
+        # The shared store is SQLite, so its calls run off the event loop
+        history = await asyncio.to_thread(conversations.get, session_id) if session_id else []
+        response = await brain.process_input_async(
+            chat['message'], chat['verbose'], chat['fast_thinking'], chat['stream'], chat['room'], history,
+            chat['router_mode'], session_id, emit, chat['deadline'], chat['single_pass'], chat['batched'], chat['timings'],
+            checkpoint
+        )
+        if session_id:
+            await asyncio.to_thread(conversations.append, session_id, chat['message'], response)
+        return response
+    except Exception as e:
+        failure = {
+            'response': f"I apologize, but something went wrong while processing your request: {str(e)}",
+            'active_regions': []
+        }
+        if emit:
+            await emit('processing_complete', failure)
+        else:
+            socketio.emit('processing_complete', failure, to=chat['room'])
+        raise
+
+async def run_job(job_id, chat, emit=None, conversations=None):
+    # Run a chat as a durable job: its events go to the job's room and are kept for replay, and its thoughts are
+    # checkpointed, so running it again after an interruption picks up where it stopped
+    chat = dict(chat, room=job_room(job_id))
+    if emit is None:
+        async def emit(event, data):
+            socketio.emit(event, data, to=chat['room'])
+    result = {}
+    await asyncio.to_thread(get_job_store().start, job_id, worker_id)
+    
+    async def record(event, data):
+        if event in JOB_REPLAY_EVENTS:
+            event_id = await asyncio.to_thread(get_job_store().record_event, job_id, event, data)
+            data = dict(data, job_id=job_id, event_id=event_id)
+            if event == 'processing_complete':
+                result.update(data)
+        await emit(event, data)
+    
+    checkpoint = await asyncio.to_thread(JobCheckpoints, get_job_store(), job_id)
+    try:
+        await run_chat(chat, record, conversations, checkpoint)
+    except Exception:
+        await asyncio.to_thread(get_job_store().finish, job_id, 'failed', result)
+        raise
+    await asyncio.to_thread(get_job_store().finish, job_id, 'done', result)
+
+def job_replay(data):
+    # The job a reconnecting client asks for and the events after the last one it saw; None if the job is unknown
+    data = data or {}
+    job_id = str(data.get('job_id', ''))
+    after = data.get('after') if isinstance(data.get('after'), int) else 0
+    if get_job_store().status(job_id) is None:
+        return job_id, None
+    return job_id, get_job_store().events(job_id, after)
+
+@app.route('/chat', methods=['POST'])
+def chat():
+    chat, error = parse_chat_request(request.json)
+    if error:
+        return jsonify({'status': 'error', 'message': error}), 400
     
-    # Initialize brain with provided Ollama settings
-    brain = BrainSystem(api_url, model)
+    # The browser that sent the message follows the job's events
+    job_id = uuid.uuid4().hex
+    sid = chat['room']
+    if sid and socketio.server.manager.is_connected(sid, '/'):
+        socketio.server.enter_room(sid, job_room(job_id), namespace='/')
     
-    # Process in a separate thread to allow for real-time updates
+    # Process on the worker pool to allow for real-time updates
     def process_message():
-        brain.process_input(user_input, verbose, fast_thinking)
+        async_runner.run(run_job(job_id, chat))
     
-    thread = threading.Thread(target=process_message)
-    thread.start()
+    try:
+        if dispatch_jobs:
+            # In multi-process mode any orchestration worker may pick the chat up
+            position = get_job_store().submit(job_id, chat)
+        else:
+            get_job_store().create(job_id, chat, worker_id)
+            position = chat_pool.submit(process_message)
+    except queue.Full:
+        if not dispatch_jobs:
+            get_job_store().discard(job_id)
+        return jsonify({
+            'status': 'busy',
+            'message': 'The brain is handling too many messages right now. Please try again shortly.',
+            'queue_depth': (get_job_store() if dispatch_jobs else chat_pool).depth()
+        }), 429
     
-    return jsonify({'status': 'processing'})
+    if position:
+        return jsonify({'status': 'queued', 'position': position, 'job_id': job_id})
+    return jsonify({'status': 'processing', 'job_id': job_id})
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    # The job's status, checkpointed thoughts and, once finished, its processing_complete result
+    status = get_job_store().status(job_id)
+    if status is None:
+        return jsonify({'status': 'error', 'message': 'Unknown job'}), 404
+    return jsonify(status)
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    job_id, events = job_replay({'job_id': job_id, 'after': request.args.get('after', 0, type=int)})
+    if events is None:
+        return jsonify({'status': 'error', 'message': 'Unknown job'}), 404
+    return jsonify({'job_id': job_id, 'events': [{'event': event, 'data': data} for event, data in events]})
+
+@app.route('/cache/stats')
+def cache_stats():
+    return jsonify(response_cache.stats())
+
+@app.route('/memory/ingest', methods=['POST'])
+def memory_ingest():
+    # Add a document to long-term memory so the Hippocampus can recall it
+    data = request.json or {}
+    text = data.get('text', '')
+    if not text.strip():
+        return jsonify({'status': 'error', 'message': 'No text to ingest'}), 400
+    chunks = get_memory_store().add_document(text, data.get('source'))
+    return jsonify({'status': 'ok', 'chunks': chunks})
+
+@app.route('/router/stats')
+def router_stats_route():
+    return jsonify(router_stats.snapshot())
+
+@app.route('/router/utility')
+def router_utility_route():
+    return jsonify(region_utility.snapshot())
+
+@app.route('/limits')
+def limits_route():
+    return jsonify(generation_limits.snapshot())
+
+@app.route('/backends')
+def backends_route():
+    return jsonify(backend_pools.stats())
+
+@app.route('/metrics')
+def metrics_route():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @socketio.on('connect')
 def handle_connect():
@@ -593,5 +3201,308 @@ def handle_connect():
 def handle_disconnect():
     print('Client disconnected')
 
+@socketio.on('resume_job')
+def handle_resume_job(data):
+    # A reconnecting client rejoins its job's room and is sent the events it missed
+    job_id, events = job_replay(data)
+    if events is None:
+        socketio.emit('job_missing', {'job_id': job_id}, to=request.sid)
+        return
+    join_room(job_room(job_id))
+    for event, payload in events:
+        socketio.emit(event, payload, to=request.sid)
+
+def resume_jobs(jobs, start):
+    # Restart the jobs an earlier run of this server left unfinished (from JobQueue.recover); their checkpoints
+    # skip the finished work
+    for job_id, chat in jobs:
+        print(f"Resuming job {job_id}")
+        start(job_id, chat)
+
+async def warm_up_async(targets=None):
+    # Build the brains for the configured (api_url, model) pairs and load their models before the first chat
+    targets = OLLAMA_WARMUP if targets is None else targets
+    await asyncio.gather(*[brain_registry.get(api_url, model).warm_up_async() for api_url, model in targets])
+
+# Async server mode (python main.py --async): every conversation is multiplexed on one event loop
+ASYNC_MAX_CONVERSATIONS = 256
+ASYNC_PORT = 5000
+
+def add_stats_routes(async_app):
+    # This process's cache, routing, limit, backend and metric stats
+    async def cache_stats(request):
+        return web.json_response(response_cache.stats())
+    
+    async def router_stats_route(request):
+        return web.json_response(router_stats.snapshot())
+    
+    async def router_utility_route(request):
+        return web.json_response(region_utility.snapshot())
+    
+    async def limits_route(request):
+        return web.json_response(generation_limits.snapshot())
+    
+    async def backends_route(request):
+        return web.json_response(backend_pools.stats())
+    
+    async def metrics_route(request):
+        return web.Response(text=metrics.render(), content_type='text/plain')
+    
+    async_app.router.add_get('/cache/stats', cache_stats)
+    async_app.router.add_get('/router/stats', router_stats_route)
+    async_app.router.add_get('/router/utility', router_utility_route)
+    async_app.router.add_get('/limits', limits_route)
+    async_app.router.add_get('/backends', backends_route)
+    async_app.router.add_get('/metrics', metrics_route)
+
+def create_async_app():
+    sio = AsyncServer(async_mode='aiohttp')
+    async_app = web.Application()
+    sio.attach(async_app)
+    
+    conversations = asyncio.Semaphore(ASYNC_MAX_CONVERSATIONS)
+    outstanding = {'count': 0}
+    tasks = set()
+    
+    async def index(request):
+        return web.FileResponse(os.path.join(app.root_path, 'templates', 'index.html'))
+    
+    async def chat(request):
+        chat, error = parse_chat_request(await request.json())
+        if error:
+            return web.json_response({'status': 'error', 'message': error}, status=400)
+        
+        # Admit up to ASYNC_MAX_CONVERSATIONS running plus CHAT_QUEUE_SIZE waiting
+        if outstanding['count'] >= ASYNC_MAX_CONVERSATIONS + CHAT_QUEUE_SIZE:
+            return web.json_response({
+                'status': 'busy',
+                'message': 'The brain is handling too many messages right now. Please try again shortly.',
+                'queue_depth': outstanding['count'] - ASYNC_MAX_CONVERSATIONS
+            }, status=429)
+        position = max(0, outstanding['count'] - ASYNC_MAX_CONVERSATIONS + 1)
+        
+        # The browser that sent the message follows the job's events
+        job_id = uuid.uuid4().hex
+        if chat['room'] and sio.manager.is_connected(chat['room'], '/'):
+            sio.enter_room(chat['room'], job_room(job_id))
+        await asyncio.to_thread(get_job_store().create, job_id, chat, worker_id)
+        start_job(job_id, chat)
+        
+        if position:
+            return web.json_response({'status': 'queued', 'position': position, 'job_id': job_id})
+        return web.json_response({'status': 'processing', 'job_id': job_id})
+    
+    def start_job(job_id, chat):
+        outstanding['count'] += 1
+        
+        async def emit(event, data):
+            await sio.emit(event, data, to=job_room(job_id))
+        
+        submitted = time.perf_counter()
+        
+        async def process_message():
+            try:
+                async with conversations:
+                    metrics.observe("chat_queue_seconds", time.perf_counter() - submitted)
+                    await run_job(job_id, chat, emit)
+            except Exception as e:
+                print(f"Chat job {job_id} failed: {e}")
+            finally:
+                outstanding['count'] -= 1
+        
+        task = asyncio.create_task(process_message())
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    
+    async def job_status_route(request):
+        status = await asyncio.to_thread(get_job_store().status, request.match_info['job_id'])
+        if status is None:
+            return web.json_response({'status': 'error', 'message': 'Unknown job'}, status=404)
+        return web.json_response(status)
+    
+    async def job_events_route(request):
+        try:
+            after = int(request.query.get('after', 0))
+        except ValueError:
+            after = 0
+        job_id, events = await asyncio.to_thread(job_replay, {'job_id': request.match_info['job_id'], 'after': after})
+        if events is None:
+            return web.json_response({'status': 'error', 'message': 'Unknown job'}, status=404)
+        return web.json_response({'job_id': job_id, 'events': [{'event': event, 'data': data} for event, data in events]})
+    
+    async def memory_ingest(request):
+        data = await request.json()
+        text = data.get('text', '')
+        if not text.strip():
+            return web.json_response({'status': 'error', 'message': 'No text to ingest'}, status=400)
+        store = await asyncio.to_thread(get_memory_store)
+        chunks = await asyncio.to_thread(store.add_document, text, data.get('source'))
+        return web.json_response({'status': 'ok', 'chunks': chunks})
+    
+    async def start_warm_up(async_app):
+        task = asyncio.create_task(warm_up_async())
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    
+    async def resume_unfinished(async_app):
+        # Only the database work runs in a thread: start_job creates tasks on this loop
+        resume_jobs(await asyncio.to_thread(get_job_store().recover, worker_id), start_job)
+    
+    async def close_client(async_app):
+        await async_ollama_client.close()
+    
+    @sio.event
+    async def connect(sid, environ):
+        print('Client connected')
+    
+    @sio.event
+    async def disconnect(sid):
+        print('Client disconnected')
+    
+    @sio.event
+    async def resume_job(sid, data):
+        job_id, events = await asyncio.to_thread(job_replay, data)
+        if events is None:
+            await sio.emit('job_missing', {'job_id': job_id}, to=sid)
+            return
+        sio.enter_room(sid, job_room(job_id))
+        for event, payload in events:
+            await sio.emit(event, payload, to=sid)
+    
+    async_app.router.add_get('/', index)
+    async_app.router.add_post('/chat', chat)
+    async_app.router.add_post('/memory/ingest', memory_ingest)
+    add_stats_routes(async_app)
+    async_app.router.add_get('/jobs/{job_id}', job_status_route)
+    async_app.router.add_get('/jobs/{job_id}/events', job_events_route)
+    async_app.on_startup.append(start_warm_up)
+    async_app.on_startup.append(resume_unfinished)
+    async_app.on_cleanup.append(close_client)
+    return async_app
+
+def run_web_worker(port, slots):
+    global dispatch_jobs, memory_store
+    dispatch_jobs = True
+    get_job_store().slots = slots
+    # Documents ingested here are recalled by every orchestration worker
+    with memory_store_lock:
+        memory_store = SharedMemoryStore()
+    # Deliver events published by any process to the clients connected here; the manager is only
+    # initialized on the first connection, so it can still be swapped in
+    manager = message_queue_manager()
+    manager.set_server(socketio.server)
+    socketio.server.manager = manager
+    socketio.run(app, host='0.0.0.0', port=port, debug=False, use_reloader=False)
+
+def run_orchestrator(slots=CHAT_WORKERS, port=ORCHESTRATOR_STATS_PORT):
+    # Run up to slots chats at once from the job queue, sending their events through the message queue, and serve
+    # this worker's stats on port. A job whose orchestrator stops sending heartbeats is taken over by another one,
+    # resuming from its checkpoints
+    global memory_store
+    conversations = SharedConversationStore()
+    with memory_store_lock:
+        memory_store = SharedMemoryStore()
+    manager = message_queue_manager(write_only=True)
+    
+    async def work():
+        while True:
+            job = await asyncio.to_thread(get_job_store().claim, worker_id)
+            if job is None:
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+                continue
+            job_id, chat, created = job
+            metrics.observe("chat_queue_seconds", time.time() - created)
+            
+            async def emit(event, data):
+                await asyncio.to_thread(manager.emit, event, data, namespace='/', room=job_room(job_id))
+            
+            try:
+                await run_job(job_id, chat, emit, conversations)
+            except Exception as e:
+                print(f"Chat job {job_id} failed: {e}")
+    
+    async def heartbeat():
+        while True:
+            await asyncio.to_thread(get_job_store().heartbeat, worker_id)
+            await asyncio.sleep(JOB_HEARTBEAT)
+    
+    async def serve():
+        stats = web.Application()
+        add_stats_routes(stats)
+        runner = web.AppRunner(stats)
+        await runner.setup()
+        await web.TCPSite(runner, '0.0.0.0', port).start()
+        warm_up = asyncio.create_task(warm_up_async())
+        try:
+            await asyncio.gather(heartbeat(), *[work() for _ in range(slots)])
+        finally:
+            warm_up.cancel()
+            await runner.cleanup()
+            await async_ollama_client.close()
+    
+    asyncio.run(serve())
+
+def run_processes(web_workers=WEB_WORKERS, orchestrators=ORCHESTRATION_WORKERS):
+    # Start every worker as its own process and stop them all when one exits or on Ctrl-C
+    script = os.path.abspath(__file__)
+    commands = [
+        [sys.executable, script, '--web-worker', '--port', str(WEB_PORT + i), '--orchestrators', str(orchestrators)]
+        for i in range(web_workers)
+    ]
+    commands += [
+        [sys.executable, script, '--orchestrator', '--port', str(ORCHESTRATOR_STATS_PORT + i)]
+        for i in range(orchestrators)
+    ]
+    processes = [subprocess.Popen(command) for command in commands]
+    # Socket.IO's polling transport needs every request from a browser to reach the same web worker
+    print(f"Web workers on ports {WEB_PORT}-{WEB_PORT + web_workers - 1}; "
+          f"put a load balancer with sticky sessions in front of them")
+    print(f"Orchestration worker stats on ports {ORCHESTRATOR_STATS_PORT}-{ORCHESTRATOR_STATS_PORT + orchestrators - 1}")
+    try:
+        while all(process.poll() is None for process in processes):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in processes:
+            process.wait()
+
 if __name__ == '__main__':
-    socketio.run(app, debug=True, host='0.0.0.0')
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Run the Braingent server")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--async', dest='async_server', action='store_true',
+                      help="serve every conversation from one event loop")
+    mode.add_argument('--processes', action='store_true',
+                      help="run separate web and orchestration worker processes")
+    mode.add_argument('--web-worker', action='store_true', help=argparse.SUPPRESS)
+    mode.add_argument('--orchestrator', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--web-workers', type=int, default=WEB_WORKERS)
+    parser.add_argument('--orchestrators', type=int, default=ORCHESTRATION_WORKERS)
+    parser.add_argument('--port', type=int)
+    args = parser.parse_args()
+    
+    if args.async_server:
+        web.run_app(create_async_app(), host='0.0.0.0', port=ASYNC_PORT)
+    elif args.processes:
+        run_processes(args.web_workers, args.orchestrators)
+    elif args.web_worker:
+        run_web_worker(args.port or WEB_PORT, args.orchestrators * CHAT_WORKERS)
+    elif args.orchestrator:
+        run_orchestrator(port=args.port or ORCHESTRATOR_STATS_PORT)
+    else:
+        threading.Thread(target=lambda: async_runner.run(warm_up_async()), name="warm-up", daemon=True).start()
+        
+        def start_job(job_id, chat):
+            try:
+                chat_pool.submit(lambda: async_runner.run(run_job(job_id, chat)))
+            except queue.Full:
+                get_job_store().finish(job_id, 'failed')
+                print(f"Could not resume job {job_id}: the chat queue is full")
+        
+        # The reloader runs this module twice; only the process that serves resumes jobs
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            resume_jobs(get_job_store().recover(worker_id), start_job)
+        socketio.run(app, debug=True, host='0.0.0.0')
\ No newline at end of file